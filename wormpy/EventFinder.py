@@ -87,13 +87,13 @@ class EventSimpleStructure:
     #if(np.shape(end_Is)[0] > 1):
     #    end_Is = np.transpose(end_Is)
     
-    if(start_Is == None):
-      self.start_Is = np.array([])
+    if(start_Is is None):
+      self.start_Is = np.array([], dtype=int)
     else:
       self.start_Is = start_Is
 
-    if(end_Is == None):
-      self.end_Is = np.array([])
+    if(end_Is is None):
+      self.end_Is = np.array([], dtype=int)
     else:
       self.end_Is = end_Is
   
@@ -110,20 +110,66 @@ class EventSimpleStructure:
     Returns
     ---------------------------------------
     boolean numpy array of size n_frames with True entries
-    only between start_Is[i] and end_Is[i], where 0 <= i < n_frames
+    only between start_Is[i] and end_Is[i] (inclusive), 
+    where 0 <= i < num_events
     
     """
     # @JimHokanson TODO
     # seg_worm.events.events2stats - move here
     # fromStruct - from the old struct version ...
     
-    # Create empty array of all False
-    mask = np.zeros(n_frames, dtype='bool')
+    return self.h__getNumActiveEvents(n_frames) > 0
 
-    for i_frame in range(n_frames):
-      mask[self.start_Is[i_frame]:self.end_Is[i_frame]] = True
+  def get_event_label_mask(self, n_frames):
+    """
+    Parameters
+    ---------------------------------------
+    n_frames: int
+    
+    Returns
+    ---------------------------------------
+    int numpy array of size n_frames, which is i for the frames between 
+    start_Is[i] and end_Is[i] (inclusive), and -1 for frames that are not 
+    part of any event. 
+    
+    This is useful for per-event statistics, e.g. 
+    np.bincount(labels[labels >= 0], data[labels >= 0]) gives the sum of
+    the data during each event.
+    
+    Notes
+    ---------------------------------------
+    The events are assumed to be in order and not to overlap, as they are 
+    when they come from EventFinder.get_events
     
-    return mask
+    """
+    # The # of events that have started at or before each frame
+    n_started = np.cumsum(self.h__getEdgeCounts(self.start_Is, n_frames))
+    
+    labels = n_started - 1
+    labels[self.h__getNumActiveEvents(n_frames) == 0] = -1
+    
+    return labels
+
+  def h__getNumActiveEvents(self, n_frames):
+    """
+    The # of events that each frame is a part of, computed as the 
+    cumulative sum of a difference array which is +1 at the start of
+    each event and -1 after its end.
+    
+    Events (or parts of them) past n_frames are ignored.
+    
+    """
+    starts = self.h__getEdgeCounts(self.start_Is, n_frames)
+    ends   = self.h__getEdgeCounts(np.asarray(self.end_Is) + 1, n_frames)
+    
+    return np.cumsum(starts - ends)
+
+  def h__getEdgeCounts(self, frames, n_frames):
+    """
+    The # of times each frame in [0,n_frames) occurs in frames
+    """
+    frames = np.asarray(frames, dtype=int)
+    return np.bincount(frames[frames < n_frames], minlength=n_frames)
 
   @classmethod
   def merge(cls, obj1, obj2):
@@ -145,8 +191,8 @@ class EventSimpleStructure:
     EventSimpleStructure : A new EventSimpleStructure instance
     
     """
-    all_starts = np.concatenate(obj1.start_Is, obj2.start_Is)
-    all_ends   = np.concatenate(obj1.end_Is,   obj2.end_Is)
+    all_starts = np.concatenate((obj1.start_Is, obj2.start_Is))
+    all_ends   = np.concatenate((obj1.end_Is,   obj2.end_Is))
     
     # @JimHokanson TODO: Would be good to check that events don't overlap ...
     
@@ -177,6 +223,9 @@ class EventFinder:
   Then call get_events() to obtain an EventSimpleStructure instance 
   containing the desired events from a given block of data.
   
+  All thresholds are optional, an empty list means the threshold is not 
+  used.
+  
   """
   
   def __init__(self):
@@ -217,8 +266,8 @@ class EventFinder:
     Parameters
     ---------------------------------------
     data    : [1 x n_frames]
-    min_threshold : [1 x n_frames]
-    max_threshold : [1 x n_frames]
+    min_threshold : [1 x n_frames] (or scalar, or [] for no threshold)
+    max_threshold : [1 x n_frames] (or scalar, or [] for no threshold)
     
     Returns
     ---------------------------------------
@@ -229,46 +278,76 @@ class EventFinder:
     If the first/last event are solely preceded/followed by NaN
     frames, these frames are swallowed into the respective event.
     
+    This is get_state_events for a single state.
+    
     """
+    return self.get_state_events(data, [min_threshold], [max_threshold])[0]
+
+  def get_state_events(self, data, min_thresholds, max_thresholds,
+                       min_sum_thresholds=None, max_sum_thresholds=None):
+    """
+    Find the events of several states at once, e.g. forward, backward and
+    paused. Each state has its own thresholds, all other options are 
+    shared. The result is the same as running get_events for each state, 
+    but the events of all states go through each step together.
     
-    # Fix the data.
-    # @MichaelCurrie: I don't understand what is going on here.  Why do
-    # we need to copy the arrays passed as parameters?  Here I am 
-    # directly copying @JimHokanson's MATLAB code without understanding.
-    data = np.copy(data)    
-    data_for_sum_threshold = np.copy(self.data_for_sum_threshold)
+    Parameters
+    ---------------------------------------
+    data    : [1 x n_frames]
+    min_thresholds : list
+      [n_states], the min_threshold of each state, see get_events
+    max_thresholds : list
+      [n_states]
+    min_sum_thresholds : list (optional)
+      [n_states], the min_sum_threshold of each state. If not given, 
+      self.min_sum_threshold is used for all states.
+    max_sum_thresholds : list (optional)
+      [n_states]
     
-    if len(data_for_sum_threshold) == 0:
-      self.data_for_sum_threshold = np.copy(data)
-
-    min_threshold = np.copy(min_threshold)
-    max_threshold = np.copy(max_threshold)
+    Returns
+    ---------------------------------------
+    list of EventSimpleStructure, one for each state
+    
+    """
+    
+    # None of the inputs are modified, so unlike the Matlab code there
+    # is no need to copy them
+    data     = np.asarray(data, dtype=float)
+    n_frames = len(data)
+    n_states = len(min_thresholds)
+    
+    data_for_sum_threshold = self.data_for_sum_threshold
+    if np.size(data_for_sum_threshold) == 0:
+      data_for_sum_threshold = data
+      
+    if min_sum_thresholds is None:
+      min_sum_thresholds = [self.min_sum_threshold]*n_states
+    if max_sum_thresholds is None:
+      max_sum_thresholds = [self.max_sum_threshold]*n_states
 
+    # For each frame, determine if it matches the threshold criteria of
+    # each state
+    event_masks = np.zeros((n_states, n_frames), dtype=bool)
+    for i_state in range(n_states):
+      event_masks[i_state] = self.get_possible_events_by_threshold(data, 
+                                np.asarray(min_thresholds[i_state], dtype=float), 
+                                np.asarray(max_thresholds[i_state], dtype=float))
 
-    # For each frame, determine if it matches our threshold criteria
-    event_mask = self.get_possible_events_by_threshold(data, 
-                                                       min_threshold, 
-                                                       max_threshold)
-    """
     # Get indices for runs of data matching criteria
-    [start_frames, end_frames] = self.get_start_stop_indices(data, event_mask)
-    
-    # Possible short circuit ...
-    if(len(start_frames)==0):
-      return EventSimpleStructure()
+    events = self.h__getStartStopIndices(data, event_masks)
     
     # In this function we remove gaps between events if the gaps are too small
     #(min_inter_frames_threshold) or too large (max_inter_frames_threshold)
-    [start_frames, end_frames] = self.h__unifyEvents(start_frames, end_frames, 
-                                       self.min_inter_frames_threshold,
-                                       self.max_inter_frames_threshold,
-                                       self.include_at_inter_frames_threshold)
+    events = self.h__unifyEvents(events, 
+                                 self.min_inter_frames_threshold,
+                                 self.max_inter_frames_threshold,
+                                 self.include_at_inter_frames_threshold)
     
     # @JimHokanson: Is this really the same thing twice with 
     #               different values ???? I'm  99% sure this 
     #               isn't done right
-    if(len(self.min_inter_sum_threshold) > 0 or 
-       len(self.max_inter_sum_threshold) > 0):
+    if(np.size(self.min_inter_sum_threshold) > 0 or 
+       np.size(self.max_inter_sum_threshold) > 0):
       raise Exception("I don't think this was coded right to start; " + 
                       "... check code - @JimHokanson")
     
@@ -280,23 +359,27 @@ class EventFinder:
     #    obj.include_at_inter_frames_threshold);
     
     # Filter events based on length
-    [start_frames,end_frames] = \
-      self.h__removeTooSmallOrLargeEvents(start_frames, end_frames,
-                                     self.min_frames_threshold, 
-                                     self.max_frames_threshold,
-                                     self.include_at_frames_threshold)
+    events = self.h__removeTooSmallOrLargeEvents(events,
+                                                 self.min_frames_threshold, 
+                                                 self.max_frames_threshold,
+                                                 self.include_at_frames_threshold)
     
     # Filter events based on data sums during event
-    [start_frames,end_frames] = \
-      self.h__removeEventsByDataSum(start_frames, end_frames,
-                               self.min_sum_threshold, 
-                               self.max_sum_threshold,
-                               self.include_at_sum_threshold, 
-                               data_for_sum_threshold)
-    
-    return EventSimpleStructure(start_frames, end_frames)
-    """
-    return EventSimpleStructure()
+    events = self.h__removeEventsByDataSum(events,
+                                           min_sum_thresholds, 
+                                           max_sum_thresholds,
+                                           self.include_at_sum_threshold, 
+                                           data_for_sum_threshold)
+    
+    start_frames, end_frames, event_states = events
+    
+    state_events = []
+    for i_state in range(n_states):
+      is_state = event_states == i_state
+      state_events.append(EventSimpleStructure(start_frames[is_state], 
+                                               end_frames[is_state]))
+    
+    return state_events
 
   
   def get_possible_events_by_threshold(self, data, min_threshold, 
@@ -306,13 +389,14 @@ class EventFinder:
     
     Parameters
     ---------------------------------------
-    data
-    min_threshold
-    max_threshold
+    data : [n_frames]
+    min_threshold : [n_frames], scalar or empty
+    max_threshold : [n_frames], scalar or empty
     
     Returns
     ---------------------------------------
-    event_mask
+    event_mask : [n_frames]
+      NaN values are never part of an event
   
     Notes
     ---------------------------------------
@@ -320,25 +404,26 @@ class EventFinder:
     seg_worm/feature/event_finder/getEvents.m
     
     """
-    pass
-    """
+
     # Start with a mask of all True
     event_mask = np.ones((len(data)), dtype=bool)
 
-    if min_threshold.size > 0:      # if min_threshold is not empty
+    with np.errstate(invalid='ignore'):
+      if min_threshold.size > 0:      # if min_threshold is not empty
         if self.include_at_threshold:
-            event_mask = data >= min_threshold
+          event_mask = data >= min_threshold
         else:
-            event_mask = data > min_threshold
-    
-    if max_threshold.size > 0:
+          event_mask = data > min_threshold
+      
+      if max_threshold.size > 0:
         if self.include_at_threshold:
-            event_mask = event_mask & data <= max_threshold
+          event_mask = event_mask & (data <= max_threshold)
         else:
-            event_mask = event_mask & data < max_threshold
-    """
+          event_mask = event_mask & (data < max_threshold)
+          
+    return event_mask
   
-  def h__getStartStopIndices(self, data, event_mask):
+  def h__getStartStopIndices(self, data, event_masks):
     """
     From a numpy event mask, get the start and stop indices.  For
     example:
@@ -353,12 +438,15 @@ class EventFinder:
     
     Parameters
     ---------------------------------------
-    data
-    event_mask
+    data : [n_frames]
+    event_masks : [n_states x n_frames]
     
     Returns
     ---------------------------------------
-    [starts, stops]
+    [starts, stops, states]
+      The first and last frame (inclusive) of each event, and the state 
+      (row of event_masks) it belongs to. The events are sorted by state, 
+      then by frame.
   
     Notes
     ---------------------------------------
@@ -366,77 +454,100 @@ class EventFinder:
     seg_worm/feature/event_finder/getEvents.m
     
     """
-    pass
-    """
+    n_states, n_frames = event_masks.shape
+
     # We concatenate falses to ensure event starts and stops at the edges
     # are caught
-    dEvent = diff([false; event_mask; false]);
-    
-    starts = find(dEvent == 1)
-    stops  = find(dEvent == -1) - 1
-    
-    if isempty(starts):
-        return
-    
-    # Include NaNs at the start and end.
-    if all(isnan(data(1:(starts(1)-1)))):
-        starts(1) = 1
+    false_column = np.zeros((n_states, 1), dtype=bool)
+    dEvent = np.diff(np.concatenate((false_column, event_masks, false_column), 
+                                    axis=1).astype(np.int8), axis=1)
+    
+    states, starts = np.nonzero(dEvent == 1)
+    stops = np.nonzero(dEvent == -1)[1] - 1
+    
+    if len(starts) == 0:
+      return starts, stops, states
+    
+    # Include NaNs at the start and end, i.e. all of the data before the
+    # first event (of each state) is NaN, or all of the data after the 
+    # last event
+    is_valid = ~np.isnan(data)
+    if np.any(is_valid):
+      first_valid_I = np.argmax(is_valid)
+      last_valid_I  = n_frames - 1 - np.argmax(is_valid[::-1])
+    else:
+      first_valid_I = n_frames
+      last_valid_I  = -1
+      
+    is_new_state = states[1:] != states[:-1]
+    is_first = np.concatenate(([True], is_new_state))
+    is_last  = np.concatenate((is_new_state, [True]))
     
-    if all(isnan(data((stops(end)+1):end))):
-        stops(end) = length(data)
-    """
-    pass
+    starts[is_first & (starts <= first_valid_I)] = 0
+    stops[is_last & (stops >= last_valid_I)]     = n_frames - 1
+      
+    return starts, stops, states
   
   
-  def h__removeGaps(self, start_frames, end_frames, right_comparison_value, fh):
+  def h__removeGaps(self, events, remove_gap_mask):
     """
+    Merge the events on either side of each gap that is to be removed
     
     Parameters
     ---------------------------------------
-      
+    events : [start_frames, end_frames, states]
+      Each is [n_events]
+    remove_gap_mask : [n_events - 1]
+      Whether to remove the gap between event i and i + 1
     
     Returns
     ---------------------------------------
-    [start_frames,end_frames]
+    [start_frames, end_frames, states]
   
+    Notes
+    ---------------------------------------
+    The Matlab code loops over the events, deleting each following event
+    whose gap is too small (or large). Here each run of events joined by
+    removed gaps is a group, which starts with the first event of the run 
+    and ends with the latest end in the run.
     
     """
+    start_frames, end_frames, states = events
     
-    # Find small gaps.
-    i = 1
-  
-    while i < len(start_frames):
-      # Swallow the gaps.
-      # NOTE: fh is either: <, <=, >, >=
-      # NOTE: This implicitly uses a sample difference (time based) approach
-      """
-      while i < length(start_frames) && fh(start_frames(i + 1) - end_frames(i) - 1,right_comparison_value):
-        #This little bit removes the gap between two events
-        end_frames(i)       = end_frames(i + 1) #Set end of this event to
-        
-        #the next event
-        start_frames(i + 1) = [] #delete the next event, it is redundant
-        end_frames(i + 1)   = [] #delete the next event
-      """
-      # Advance.
-      i += 1
-  
+    # The first event of each group
+    group_start_I = np.flatnonzero(np.concatenate(([True], ~remove_gap_mask)))
+    
+    start_frames = start_frames[group_start_I]
+    end_frames   = np.maximum.reduceat(end_frames, group_start_I)
+    states       = states[group_start_I]
+    
+    return start_frames, end_frames, states
   
   
-  def h__unifyEvents(self, start_frames, end_frames, 
+  def h__unifyEvents(self, events, 
                      min_inter_frames_threshold, max_inter_frames_threshold, 
                      include_at_inter_frames_threshold):
     """
     
     Parameters
     ---------------------------------------
-    start_frames:
-    end_frames:
+    events : [start_frames, end_frames, states]
+    min_inter_frames_threshold: scalar or []
+    max_inter_frames_threshold: scalar or []
+    include_at_inter_frames_threshold: bool
     
     Returns
     ---------------------------------------
-    [start_frames,end_frames]
+    [start_frames, end_frames, states]
   
+    Notes
+    ---------------------------------------
+    In the Matlab code the small gaps are removed first, and then the large
+    gaps. Removing gaps doesn't change the remaining gaps, so this is the 
+    same as removing all gaps that are either too small or too large at 
+    once.
+    
+    Only gaps between events of the same state are removed.
     
     """
     
@@ -445,7 +556,7 @@ class EventFinder:
     #
     #   These functions are run on the time between frames
     #
-    """
+
     #NOTE: This function could also exist for:
     #- min_inter_sum_threshold
     #- max_inter_sum_threshold
@@ -453,30 +564,43 @@ class EventFinder:
     #   but the old code did not include any data in:
     #   h__removeGaps
     
+    start_frames, end_frames, states = events
+    
+    # NOTE: This implicitly uses a sample difference (time based) approach
+    gaps = start_frames[1:] - end_frames[:-1] - 1
+    
+    remove_gap_mask = np.zeros(len(gaps), dtype=bool)
+    
     # Unify small time gaps.
     #Translation: if the gap between events is small, merge the events
-    if len(min_inter_frames_threshold) > 0: #~isempty(min_inter_frames_threshold):
-        if include_at_inter_frames_threshold:
-            [start_frames,end_frames] = h__removeGaps(start_frames,end_frames,min_inter_frames_threshold,@le); #  <=
-        else: # the threshold is exclusive
-            [start_frames,end_frames] = h__removeGaps(start_frames,end_frames,min_inter_frames_threshold,@lt); #  <
+    if np.size(min_inter_frames_threshold) > 0:
+      if include_at_inter_frames_threshold:
+        comparison = '<='
+      else: # the threshold is exclusive
+        comparison = '<'
+      remove_gap_mask |= h__compare(gaps, min_inter_frames_threshold, 
+                                    comparison)
     
     #????? - when would this one ever be useful??????
     # Unify large time gaps.
     #Translation: if the gap between events is large, merge the events
-    if ~isempty(max_inter_frames_threshold):
-        if include_at_inter_frames_threshold:
-            [start_frames,end_frames] = h__removeGaps(start_frames,end_frames,max_inter_frames_threshold,@ge); #  >=
-        else:
-            # the threshold is exclusive
-            [start_frames,end_frames] = h__removeGaps(start_frames,end_frames,max_inter_frames_threshold,@gt); #  >=
-    """
-    pass
-  
-  
+    if np.size(max_inter_frames_threshold) > 0:
+      if include_at_inter_frames_threshold:
+        comparison = '>='
+      else: # the threshold is exclusive
+        comparison = '>'
+      remove_gap_mask |= h__compare(gaps, max_inter_frames_threshold, 
+                                    comparison)
+    
+    remove_gap_mask &= states[1:] == states[:-1]
+    
+    if not np.any(remove_gap_mask):
+      return events
+    
+    return self.h__removeGaps(events, remove_gap_mask)
   
   
-  def h__removeTooSmallOrLargeEvents(self, start_frames, end_frames,
+  def h__removeTooSmallOrLargeEvents(self, events,
                                      min_frames_threshold, max_frames_threshold,
                                      include_at_frames_threshold):
     """
@@ -484,131 +608,107 @@ class EventFinder:
     
     Parameters
     ---------------------------------------
+    events : [start_frames, end_frames, states]
+    min_frames_threshold : scalar or []
+    max_frames_threshold : scalar or []
+    include_at_frames_threshold : bool
     
     Returns
     ---------------------------------------
-    [start_frames,end_frames]
+    [start_frames, end_frames, states]
   
     
-    """
-    pass
-    
     """
     # Check the event frames.
-    if ~(isempty(min_frames_threshold) and isempty(max_frames_threshold)):
-        # Compute the event frames.
-        n_frames_per_event = end_frames - start_frames + 1
-        
-        # Remove small events.
-        removeEvents = false(size(n_frames_per_event))
-        if ~isempty(min_frames_threshold):
-            if include_at_frames_threshold:
-                removeEvents = n_frames_per_event <= min_frames_threshold
-            else:
-                removeEvents = n_frames_per_event < min_frames_threshold
-        
-        # Remove large events.
-        if ~isempty(max_frames_threshold):
-            if include_at_frames_threshold:
-                removeEvents = removeEvents | n_frames_per_event >= max_frames_threshold
-            else:
-                removeEvents = removeEvents | n_frames_per_event > max_frames_threshold
-        
-        # Remove the events.
-        start_frames(removeEvents) = []
-        end_frames(removeEvents)   = []
-        
-    """  
-    pass
+    if np.size(min_frames_threshold) == 0 and \
+       np.size(max_frames_threshold) == 0:
+      return events
+      
+    start_frames, end_frames, states = events
+      
+    # Compute the event frames.
+    n_frames_per_event = end_frames - start_frames + 1
+    
+    remove_events = h__getEventsOutsideThresholds(n_frames_per_event, 
+                                                  min_frames_threshold,
+                                                  max_frames_threshold,
+                                                  include_at_frames_threshold)
     
+    # Remove the events.
+    return tuple(x[~remove_events] for x in events)
     
-  def h__removeEventsByDataSum(self, start_frames, end_frames,
-                               min_sum_threshold, max_sum_threshold,
+    
+  def h__removeEventsByDataSum(self, events,
+                               min_sum_thresholds, max_sum_thresholds,
                                include_at_sum_threshold, data_for_sum_threshold):
     """
     
     Parameters
     ---------------------------------------
+    events : [start_frames, end_frames, states]
+    min_sum_thresholds : list
+      [n_states], each is scalar, [n_frames] or []
+    max_sum_thresholds : list
+      [n_states], each is scalar, [n_frames] or []
+      For a threshold per frame, the threshold of an event is the mean 
+      (ignoring NaNs) of the thresholds during the event.
+    include_at_sum_threshold : bool
+    data_for_sum_threshold : [n_frames]
     
     Returns
     ---------------------------------------
-    [start_frames,end_frames]
+    [start_frames, end_frames, states]
   
     
     """
+    
+    n_states = len(min_sum_thresholds)
+    
+    has_thresholds = [np.size(min_sum_thresholds[i]) > 0 or 
+                      np.size(max_sum_thresholds[i]) > 0 
+                      for i in range(n_states)]
   
-    if len(min_sum_threshold) == 0 and len(max_sum_threshold) == 0:
-       return 
+    if not any(has_thresholds):
+      return events
+    
+    start_frames, end_frames, states = events
     
-    """    
     #????? - why do we do a sum in one location and a mean in the other????
     #------------------------------------------------------------------
     # Compute the event sums.
-    eventSums = nan(length(start_frames), 1);
-    for i = 1:length(eventSums)
-        eventSums(i) = nansum(data_for_sum_threshold((start_frames(i)):(end_frames(i))));
-    end
-    
-    # Compute the event sum thresholds.
-    if length(min_sum_threshold) > 1 #i.e. if not a scaler
-        newMinSumThr = nan(size(eventSums));
-        for i = 1:length(newMinSumThr)
-            newMinSumThr(i) = nanmean(min_sum_threshold((start_frames(i)):(end_frames(i))));
-        end
-        min_sum_threshold = newMinSumThr;
-    end
-    
-    if length(max_sum_threshold) > 1
-        newMaxSumThr = nan(size(eventSums));
-        for i = 1:length(newMaxSumThr)
-            newMaxSumThr(i) = nanmean(max_sum_threshold((start_frames(i)):(end_frames(i))));
-        end
-        max_sum_threshold = newMaxSumThr;
-    end
+    event_sums = h__getEventNanSums(data_for_sum_threshold, 
+                                    start_frames, end_frames)[0]
+    
+    # Compute the event sum thresholds. States without a threshold get NaN,
+    # which never removes an event.
+    min_sum_threshold = np.zeros(len(event_sums)) * np.NaN
+    max_sum_threshold = np.zeros(len(event_sums)) * np.NaN
+    for i_state in range(n_states):
+      if not has_thresholds[i_state]:
+        continue
+      is_state = states == i_state
+      for event_threshold, threshold in \
+          ((min_sum_threshold, min_sum_thresholds[i_state]),
+           (max_sum_threshold, max_sum_thresholds[i_state])):
+        if np.size(threshold) > 0:
+          event_threshold[is_state] = \
+            h__getEventThresholds(threshold, start_frames[is_state], 
+                                  end_frames[is_state])
         
     #Actual filtering of the data
     #------------------------------------------------------------------
-    # Remove small events.
-    removeEvents = false(size(eventSums));
-    if ~isempty(min_sum_threshold)
-        if include_at_sum_threshold
-            removeEvents = eventSums <= min_sum_threshold;
-        else
-            removeEvents = eventSums < min_sum_threshold;
-        end
-    end
-    
-    # Remove large events.
-    if ~isempty(max_sum_threshold)
-        if include_at_sum_threshold
-            removeEvents =  removeEvents | eventSums >= max_sum_threshold;
-        else
-            removeEvents =  removeEvents | eventSums > max_sum_threshold;
-        end
-    end
+    remove_events = h__getEventsOutsideThresholds(event_sums, 
+                                                  min_sum_threshold,
+                                                  max_sum_threshold,
+                                                  include_at_sum_threshold)
     
     # Remove the events.
-    start_frames(removeEvents) = [];
-    end_frames(removeEvents)   = [];
-    """
-    pass
+    return tuple(x[~remove_events] for x in events)
   
 
 
 
 
-
-
-
-
-
-
-
-
-
-
-
-
 class EventOutputStructure:
   """
   EventOutputStructure
@@ -913,4 +1013,130 @@ class EventOutputStructure:
   
 # HELPER FUNCTIONS
 
+# The comparisons used for the thresholds, by their Matlab names
+_COMPARISONS = {'<':  np.less, 
+                '<=': np.less_equal, 
+                '>':  np.greater, 
+                '>=': np.greater_equal}
+
+def h__compare(values, right_comparison_value, comparison):
+  """
+  Parameters
+  ---------------------------------------
+  values : numpy array
+  right_comparison_value : scalar or numpy array
+  comparison : string
+    One of '<', '<=', '>', '>='
+  
+  Returns
+  ---------------------------------------
+  values (comparison) right_comparison_value, e.g. values < 3
+  
+  """
+  if comparison not in _COMPARISONS:
+    raise Exception("Unrecognized comparison: " + str(comparison))
+  
+  return _COMPARISONS[comparison](values, right_comparison_value)
+
+def h__getEventsOutsideThresholds(values, min_threshold, max_threshold, 
+                                  include_at_threshold):
+  """
+  Find the events to remove because their values are too small or large
+  
+  Parameters
+  ---------------------------------------
+  values : [n_events]
+  min_threshold : scalar, [n_events] or []
+  max_threshold : scalar, [n_events] or []
+    Comparisons with NaN thresholds are False, so they remove nothing.
+  include_at_threshold : bool
+    If True, events at the thresholds are removed as well
+    
+  Returns
+  ---------------------------------------
+  remove_events : [n_events]
+  
+  """
+  remove_events = np.zeros(len(values), dtype=bool)
+  
+  with np.errstate(invalid='ignore'):
+    # Remove small events.
+    if np.size(min_threshold) > 0:
+      if include_at_threshold:
+        remove_events |= h__compare(values, min_threshold, '<=')
+      else:
+        remove_events |= h__compare(values, min_threshold, '<')
+    
+    # Remove large events.
+    if np.size(max_threshold) > 0:
+      if include_at_threshold:
+        remove_events |= h__compare(values, max_threshold, '>=')
+      else:
+        remove_events |= h__compare(values, max_threshold, '>')
+  
+  return remove_events
+
+def h__getEventNanSums(data, start_frames, end_frames):
+  """
+  The sum of the data during each event, ignoring NaN values, along with 
+  the # of values that aren't NaN.
+  
+  Parameters
+  ---------------------------------------
+  data : [n_frames]
+  start_frames : [n_events]
+  end_frames : [n_events]
+    The last frame of each event (inclusive)
+  
+  Returns
+  ---------------------------------------
+  [event_sums, event_counts]
+    Both are [n_events]. An event with only NaN values has a sum of 0
+    (like np.nansum) and a count of 0.
+    
+  Notes
+  ---------------------------------------
+  Rather than summing over each event, the data is summed once, and the 
+  sum of each event is the difference of the cumulative sum at its edges. 
+  
+  """
+  data   = np.asarray(data, dtype=float)
+  is_nan = np.isnan(data)
+  
+  cum_sum   = np.concatenate(([0], np.cumsum(np.where(is_nan, 0, data))))
+  cum_count = np.concatenate(([0], np.cumsum(~is_nan)))
+  
+  end_frames = end_frames + 1
+  
+  return (cum_sum[end_frames] - cum_sum[start_frames],
+          cum_count[end_frames] - cum_count[start_frames])
+
+def h__getEventThresholds(threshold, start_frames, end_frames):
+  """
+  Convert a threshold to a threshold per event.
+  
+  Parameters
+  ---------------------------------------
+  threshold : [n_frames], scalar or []
+  start_frames : [n_events]
+  end_frames : [n_events]
+  
+  Returns
+  ---------------------------------------
+  threshold : [n_events], scalar or []
+    For a threshold per frame, the threshold of each event is the mean 
+    of its frames, ignoring NaN values (NaN if all are NaN). Otherwise 
+    the threshold is returned as is.
+  
+  """
+  threshold = np.asarray(threshold, dtype=float)
+  
+  if threshold.size <= 1: #i.e. if a scalar or empty
+    return threshold
+  
+  event_sums, event_counts = h__getEventNanSums(threshold, 
+                                                start_frames, end_frames)
+  with np.errstate(invalid='ignore', divide='ignore'):
+    return event_sums / event_counts
+
 
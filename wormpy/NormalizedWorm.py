@@ -12,11 +12,292 @@
 """
 
 import warnings
+import copy
 import numpy as np
 import scipy.io
+import h5py
 import os
+import hashlib
+import shutil
+import tempfile
+import glob
+import re
+import concurrent.futures
 from wormpy import config
 
+class LazyDataDict(dict):
+  """
+  A dictionary whose values are only loaded when they are first accessed.
+  Once loaded, a value is kept like in any other dictionary.
+  
+  Membership, get, iteration, len, keys, items and values all cover the
+  keys that have not been loaded yet, so that it can be used like any 
+  other complete dictionary. items and values load every value.
+  
+  Attributes
+  ---------------------------------------
+  lazy_keys : list
+    The keys that can be loaded, loaded or not
+  
+  """
+  
+  def __init__(self, lazy_keys, load_value):
+    """
+    Parameters
+    ---------------------------------------
+    lazy_keys : list
+    load_value : function
+      Called with a key to get its value
+      
+    """
+    super(LazyDataDict, self).__init__()
+    self.lazy_keys   = list(lazy_keys)
+    self._load_value = load_value
+    
+  def __missing__(self, key):
+    if key not in self.lazy_keys:
+      raise KeyError(key)
+    
+    value = self._load_value(key)
+    self[key] = value
+    return value
+  
+  def __contains__(self, key):
+    return key in self.lazy_keys or super(LazyDataDict, self).__contains__(key)
+  
+  def get(self, key, default=None):
+    if key in self:
+      return self[key]
+    else:
+      return default
+  
+  def keys(self):
+    # Any keys that were set directly follow the lazy keys
+    return self.lazy_keys + [x for x in super(LazyDataDict, self).keys() 
+                             if x not in self.lazy_keys]
+  
+  def __iter__(self):
+    return iter(self.keys())
+  
+  def __len__(self):
+    return len(self.keys())
+  
+  def items(self):
+    return [(x, self[x]) for x in self.keys()]
+  
+  def values(self):
+    return [self[x] for x in self.keys()]
+    
+  def load_all(self):
+    """
+    Load all values that have not yet been loaded
+    """
+    for key in self.lazy_keys:
+      self[key]
+
+def h__loadHDF5Field(dataset):
+  """
+  Read a field of a Matlab -v7.3 struct, returning what scipy.io.loadmat
+  would with squeeze_me = True.
+  
+  Parameters
+  ---------------------------------------
+  dataset : h5py.Dataset
+  
+  """
+  # Matlab arrays are column-major, so the dimensions are stored reversed
+  value = np.squeeze(dataset[()].T)
+  
+  matlab_class = dataset.attrs.get('MATLAB_class', b'')
+  if isinstance(matlab_class, bytes):
+    matlab_class = matlab_class.decode()
+  
+  if matlab_class == 'char':
+    # Characters are stored as uint16 codes
+    value = ''.join(chr(x) for x in np.atleast_1d(value))
+  elif value.ndim == 0:
+    value = value.item()
+  
+  return value
+
+# The values saved for each frame in a normBlock, after the segmentation 
+# status, and their shape in a single frame
+NORM_BLOCK_FIELDS = [('vulva_contours',     (49, 2)),
+                     ('non_vulva_contours', (49, 2)),
+                     ('skeletons',          (49, 2)),
+                     ('angles',             (49,)),
+                     ('in_out_touches',     (49,)),
+                     ('lengths',            ()),
+                     ('widths',             (49,)),
+                     ('head_areas',         ()),
+                     ('tail_areas',         ()),
+                     ('vulva_areas',        ()),
+                     ('non_vulva_areas',    ())]
+
+def h__loadNormBlock(block_file_path, block_name):
+  """
+  Read a normBlock file. This is run in the worker processes of
+  NormalizedWorm.load_normalized_blocks.
+  
+  Returns
+  ---------------------------------------
+  (segmentation_status, values)
+    segmentation_status : [n_frames] single characters
+    values : list of arrays, one per NORM_BLOCK_FIELDS, with the frames 
+      along the last dimension
+  
+  """
+  block = scipy.io.loadmat(block_file_path, 
+                           squeeze_me = True, 
+                           struct_as_record = False)[block_name]
+  
+  segmentation_status = np.array(list(block[0]))
+  n_frames = len(segmentation_status)
+  
+  # Undo squeeze_me, which drops the frame dimension of 1 frame blocks
+  values = [np.asarray(x, dtype=float).reshape(shape + (n_frames,)) 
+            for x, (_, shape) in zip(block[1:], NORM_BLOCK_FIELDS)]
+  
+  return segmentation_status, values
+
+def get_cache_path(data_file_path, cache_root=None):
+  """
+  The directory in which NormalizedWorm.from_cache stores the data of a
+  norm_obj.mat file. The directory is named by the SHA-1 hash of the 
+  file, so that a changed file is not read from an old cache.
+  
+  Parameters
+  ---------------------------------------
+  data_file_path : string
+  cache_root : string (optional)
+    The directory holding all the caches. The default is a 
+    '.wormpy_cache' directory next to the data file.
+  
+  Notes
+  ---------------------------------------
+  Hashing a long recording takes seconds, so the hash is kept in a 
+  sidecar file in cache_root along with the size and modification time
+  of the file. The file is only hashed again when these change.
+    
+  """
+  data_file_path = os.path.abspath(data_file_path)
+  
+  if cache_root is None:
+    cache_root = os.path.join(os.path.dirname(data_file_path), '.wormpy_cache')
+  
+  file_stat = os.stat(data_file_path)
+  file_key  = '%d %d' % (file_stat.st_size, file_stat.st_mtime_ns)
+  
+  # The sidecar is named by the hash of the path of the file
+  sidecar_path = os.path.join(cache_root, 
+      hashlib.sha1(data_file_path.encode('utf-8')).hexdigest() + '.sha1')
+  
+  try:
+    with open(sidecar_path, 'r') as f:
+      saved_key, saved_hash = f.read().rsplit(' ', 1)
+    if saved_key == file_key:
+      return os.path.join(cache_root, saved_hash)
+  except (OSError, ValueError):
+    pass
+  
+  file_hash = hashlib.sha1()
+  with open(data_file_path, 'rb') as f:
+    for chunk in iter(lambda: f.read(2**20), b''):
+      file_hash.update(chunk)
+  file_hash = file_hash.hexdigest()
+  
+  # The sidecar is only an optimization, so a cache_root that can't be 
+  # written to is not an error
+  try:
+    if not os.path.isdir(cache_root):
+      os.makedirs(cache_root)
+    
+    temp_fd, temp_path = tempfile.mkstemp(dir=cache_root)
+    with os.fdopen(temp_fd, 'w') as f:
+      f.write(file_key + ' ' + file_hash)
+    os.replace(temp_path, sidecar_path)
+  except OSError:
+    pass
+  
+  return os.path.join(cache_root, file_hash)
+
+class FrameRuns():
+  """
+  The runs of consecutive frames for which a mask is True, e.g. the runs 
+  of frames with a skeleton.
+  
+  Attributes
+  ---------------------------------------
+  mask : [n_frames] bool
+  starts : [n_runs]
+    The first frame of each run
+  lengths : [n_runs]
+    The # of frames in each run
+    
+  """
+  
+  def __init__(self, mask):
+    
+    self.mask = np.asarray(mask, dtype=bool)
+    
+    # Pad with False so that runs at the edges have a start and an end
+    d_mask = np.diff(np.concatenate(([False], self.mask, [False])).astype(np.int8))
+    
+    self.starts  = np.flatnonzero(d_mask == 1)
+    self.lengths = np.flatnonzero(d_mask == -1) - self.starts
+  
+  @property
+  def ends(self):
+    """
+    The frame after the last frame of each run, i.e. 
+    mask[starts[i]:ends[i]] is a run
+    """
+    return self.starts + self.lengths
+  
+  @property
+  def n_runs(self):
+    return len(self.starts)
+
+class FrameWindow():
+  """
+  A window of consecutive frames of a NormalizedWorm, see 
+  NormalizedWorm.iter_frame_windows
+  
+  Attributes
+  ---------------------------------------
+  start : int
+    The first frame that the window is for
+  stop : int
+    The frame after the last frame that the window is for
+  halo_start : int
+    The first frame of the data of the window, start minus the halo 
+    (but not before the first frame)
+  halo_stop : int
+    The frame after the last frame of the data of the window
+  nw : NormalizedWorm
+    The worm for frames halo_start to halo_stop
+  
+  """
+  
+  def __init__(self, nw, start, stop, halo_start, halo_stop):
+    self.nw         = nw
+    self.start      = start
+    self.stop       = stop
+    self.halo_start = halo_start
+    self.halo_stop  = halo_stop
+  
+  @property
+  def core(self):
+    """
+    The slice of the frames of window.nw that the window is for, i.e.
+    excluding the halo
+    """
+    return slice(self.start - self.halo_start, self.stop - self.halo_start)
+    
+  def __repr__(self):
+    return 'FrameWindow: frames %d to %d, with halo %d to %d' % \
+      (self.start, self.stop, self.halo_start, self.halo_stop)
+
 class NormalizedWorm():
   """ 
   NormalizedWorm encapsulates the normalized measures data, loaded
@@ -94,13 +375,23 @@ class NormalizedWorm():
   # this stores a dictionary of various ways of organizing the partitions
   worm_parititon_subsets = None
   
-  data_dict = None  # A dictionary of all data in norm_obj.mat
+  data_dict = None  # A dictionary of all data in norm_obj.mat, see LazyDataDict
   
   # shape = (7, 48)
   # NOTE: It is one less than 49 because
   #       the values are calculated from paired values, 
   #       and the # of pairs is one less than the # of samples
   eigen_worms = None
+  
+  # Cumulative sums over the 49 points of the data in data_dict, 
+  # see get_partition_mean
+  _partition_cumsums = None
+  
+  # see frame_runs
+  _frame_runs = None
+  
+  # see contours
+  _contours = None
 
   def __init__(self, data_file_path, eigen_worm_file_path):
     """ 
@@ -110,11 +401,13 @@ class NormalizedWorm():
     Parameters
     ---------------------------------------
     data_file_path: string
+      Pass in None to skip loading the worm data, see from_cache
     
     eigen_worm_file_path: string
     
     """
-    self.load_normalized_data(data_file_path)
+    if data_file_path is not None:
+      self.load_normalized_data(data_file_path)
     self.load_eigen_worms(eigen_worm_file_path)
     
     # all are valid partitions of the worm's 49 skeleton points:
@@ -230,48 +523,96 @@ class NormalizedWorm():
     +seg_worm / @skeleton_indices / skeleton_indices.m
       
     """
-    #We use numpy.split to split a data_dict element into three, cleaved
-    #first by the first entry in the duple worm_partitions[partition_key],
-    #and second by the second entry in that duple.
-    
-    #Taking the second element of the resulting list of arrays, i.e. [1],
-    #gives the partitioned component we were looking for.
-    partition = np.split(self.data_dict[data_key], 
-                    self.worm_partitions[partition_key])[1]
+    #Slicing the points dimension by the duple worm_partitions[partition_key]
+    #gives a view of the data, so nothing is copied, or for data from 
+    #from_cache, read from disk until it is used.
+    partition = self.data_dict[data_key][slice(*self.worm_partitions[partition_key])]
     
     if(split_spatial_dimensions):
       return partition[:,0,:], partition[:,1,:]
     else:
       return partition
+
+  def get_partition_mean(self, partition_key, data_key = 'skeletons'):
+    """
+    The frame-by-frame mean of a partition of a measurement of the worm,
+    e.g. the centroid of the head. This is the same as 
+    np.mean(self.get_partition(partition_key, data_key), 0), including 
+    being NaN wherever a value of the partition is NaN.
+    
+    Parameters
+    ---------------------------------------    
+    partition_key: string
+      The desired partition.  e.g. 'head', 'tail', etc.
+      
+    data_key: string  (optional)
+      The desired measurement (default is 'skeletons')
+    
+    Returns
+    ---------------------------------------    
+    A numpy array of the mean, e.g. of shape (2,n) for 'skeletons' or
+    (n) for 'widths'
+    
+    Notes
+    ---------------------------------------    
+    The first time a measurement is requested its cumulative sum over the 
+    49 points is computed, along with a cumulative count of its NaN values. 
+    The mean of any partition then only requires the difference between 
+    two rows of each, rather than another reduction over the data.
+    
+    """
+    if self._partition_cumsums is None:
+      self._partition_cumsums = {}
+    
+    if data_key not in self._partition_cumsums:
+      data   = self.data_dict[data_key]
+      is_nan = np.isnan(data)
+      data   = np.where(is_nan, 0, data)
+      
+      #Summing relative to the first point keeps the sums, and thus
+      #the rounding errors, on the scale of the worm rather than the plate
+      offset = data[0]
+      
+      zero_row  = np.zeros((1,) + data.shape[1:])
+      cum_sum   = np.concatenate((zero_row, np.cumsum(data - offset, 0)))
+      cum_n_nan = np.concatenate((zero_row.astype(int), 
+                                  np.cumsum(is_nan, 0)))
+      
+      self._partition_cumsums[data_key] = (offset, cum_sum, cum_n_nan)
+    
+    offset, cum_sum, cum_n_nan = self._partition_cumsums[data_key]
+    
+    n_points = cum_sum.shape[0] - 1
+    start, stop, _ = \
+      slice(*self.worm_partitions[partition_key]).indices(n_points)
+    
+    partition_mean = offset + (cum_sum[stop] - cum_sum[start]) / (stop - start)
+    partition_mean[cum_n_nan[stop] != cum_n_nan[start]] = np.NaN
+    
+    return partition_mean
     
   def load_normalized_data(self, data_file_path):
     """ 
     Load the norm_obj.mat file into this class
+    
+    The fields of data_dict are not read until they are first accessed, 
+    so that e.g. computing only the morphology features does not read the 
+    contours or the angles. 
 
     Notes
     ---------------------------------------    
     Translated from getObject in SegwormMatlabClasses
     
+    For -v7.3 (HDF5) files each field is read from the file on its own. 
+    Older .mat files can only be read in full, so the whole file is read 
+    the first time any field is accessed.
+    
     """
     
     if(not os.path.isfile(data_file_path)):
       raise Exception("Data file not found: " + data_file_path)
     else:
-      self.data_file = scipy.io.loadmat(data_file_path, 
-                                        # squeeze unit matrix dimensions:
-                                        squeeze_me = True, 
-                                        # force return numpy object array:
-                                        struct_as_record = False)
-
-      # self.data_file is a dictionary, with keys:
-      # self.data_file.keys() = 
-      # dict_keys(['__header__', 's', '__version__', '__globals__'])
-      
-      # All the action is in data_file['s'], which is a numpy.ndarray where
-      # data_file['s'].dtype is an array showing how the data is structured.
-      # it is structured in precisely the order specified in data_keys below
-
-      staging_data = self.data_file['s']
+      self.data_file = None
 
       # NOTE: These are aligned to the order in the files.
       # these will be the keys of the dictionary data_dict
@@ -304,18 +645,44 @@ class NormalizedWorm():
                 'x',                  # shape is (49, n) integer
                 'y']                  # shape is (49, n) integer
       
-      # Here I use powerful python syntax to reference data elements of s
-      # dynamically through built-in method getattr
-      # that is, getattr(s, x)  works syntactically just like s.x, 
-      # only x is a variable, so we can do a list comprehension with it!
-      # this is to build up a nice dictionary containing the data in s
-      self.data_dict = {x: getattr(staging_data, x) for x in data_keys}
-      
-      # Let's change the string of length n to a numpy array of single 
-      # characters of length n, to be consistent with the other data 
-      # structures
-      self.data_dict['segmentation_status'] = \
-        np.array(list(self.data_dict['segmentation_status']))
+      if h5py.is_hdf5(data_file_path):
+        def load_field(key):
+          with h5py.File(data_file_path, 'r') as h:
+            return h__loadHDF5Field(h['s'][key])
+      else:
+        def load_field(key):
+          if self.data_file is None:
+            self.data_file = scipy.io.loadmat(data_file_path, 
+                                        # squeeze unit matrix dimensions:
+                                        squeeze_me = True, 
+                                        # force return numpy object array:
+                                        struct_as_record = False)
+          
+          # self.data_file is a dictionary, with keys:
+          # self.data_file.keys() = 
+          # dict_keys(['__header__', 's', '__version__', '__globals__'])
+          
+          # All the action is in data_file['s'], which is a numpy.ndarray 
+          # where data_file['s'].dtype is an array showing how the data is 
+          # structured. It is structured in precisely the order specified 
+          # in data_keys above
+          return getattr(self.data_file['s'], key)
+      
+      def load_value(key):
+        value = load_field(key)
+        
+        if key == 'segmentation_status':
+          # Let's change the string of length n to a numpy array of single 
+          # characters of length n, to be consistent with the other data 
+          # structures
+          value = np.array(list(value))
+        
+        return value
+      
+      self.data_dict = LazyDataDict(data_keys, load_value)
+      self._partition_cumsums = None
+      self._frame_runs = None
+      self._contours = None
         
       # TODO: @MichaelCurrie: do this.  but I'm not sure how the file 
       # knows where the eigenworm file is
@@ -324,6 +691,199 @@ class NormalizedWorm():
     
       self.load_frame_code_descriptions()    
     
+  def write_cache(self, cache_path):
+    """
+    Write each field of data_dict to its own .npy file, to be read back 
+    by from_cache.
+    
+    Parameters
+    ---------------------------------------
+    cache_path : string
+      The directory to create, see get_cache_path
+    
+    Notes
+    ---------------------------------------
+    The files are written to a temporary directory which is then renamed,
+    so that an interrupted write does not leave behind a partial cache.
+    
+    """
+    cache_root = os.path.dirname(os.path.abspath(cache_path))
+    if not os.path.isdir(cache_root):
+      os.makedirs(cache_root)
+    
+    temp_path = tempfile.mkdtemp(dir=cache_root)
+    try:
+      for key, value in self.data_dict.items():
+        np.save(os.path.join(temp_path, key + '.npy'), np.asarray(value),
+                allow_pickle=False)
+      
+      # The contour is also stored whole, so that contour_x and contour_y
+      # can be views of it
+      np.save(os.path.join(temp_path, 'contours.npy'), self.contours)
+      try:
+        os.rename(temp_path, cache_path)
+      except OSError:
+        # Another process may have written the same cache in the meantime
+        if not os.path.isdir(cache_path):
+          raise
+    finally:
+      # Nothing is left once the rename succeeds
+      shutil.rmtree(temp_path, ignore_errors=True)
+  
+  @staticmethod
+  def from_cache(data_file_path, eigen_worm_file_path, cache_root=None):
+    """
+    Like NormalizedWorm(data_file_path, eigen_worm_file_path), but the
+    data are memory-mapped from a cache of .npy files, which is created 
+    from data_file_path the first time it is used.
+    
+    Parameters
+    ---------------------------------------
+    data_file_path : string
+    eigen_worm_file_path : string
+    cache_root : string (optional)
+      see get_cache_path
+    
+    Notes
+    ---------------------------------------
+    The memory-mapped arrays are read only. skeleton_x, contour_x, 
+    get_partition, etc. return views of them, so only the pages that are 
+    used are read, and processes working on the same worm share them 
+    through the OS file cache.
+    
+    """
+    cache_path = get_cache_path(data_file_path, cache_root)
+    
+    if not os.path.isdir(cache_path):
+      NormalizedWorm(data_file_path, eigen_worm_file_path).write_cache(cache_path)
+    
+    def load_value(key):
+      value = np.load(os.path.join(cache_path, key + '.npy'), mmap_mode='r')
+      
+      # e.g. EIGENWORM_PATH, which is saved as a 0-d string array
+      if value.ndim == 0:
+        value = value.item()
+      
+      return value
+    
+    # The contour is derived from the data, see write_cache, so it is kept
+    # out of data_dict
+    data_keys = [os.path.splitext(x)[0] for x in sorted(os.listdir(cache_path))]
+    data_keys.remove('contours')
+    
+    nw = NormalizedWorm(None, eigen_worm_file_path)
+    nw.data_file = None
+    nw.data_dict = LazyDataDict(data_keys, load_value)
+    nw._contours = np.load(os.path.join(cache_path, 'contours.npy'), 
+                           mmap_mode='r')
+    nw.load_frame_code_descriptions()
+    
+    return nw
+    
+  def get_copy_with_data(self, data_dict):
+    """
+    A NormalizedWorm with the same partitions, eigen worms, etc. as this 
+    one, but with the data in data_dict
+    
+    """
+    nw = copy.copy(self)
+    nw.data_dict = data_dict
+    nw._partition_cumsums = None
+    nw._frame_runs = None
+    nw._contours = None
+    
+    return nw
+  
+  def concatenate_frames(self, other):
+    """
+    A NormalizedWorm of the frames of this worm followed by those of 
+    other, e.g. for adding newly tracked frames.
+    
+    Parameters
+    ---------------------------------------
+    other : NormalizedWorm
+    
+    """
+    data_dict = {}
+    for key in other.data_dict:
+      value = other.data_dict[key]
+      
+      # The frames are along the last dimension, see get_frame_window
+      if isinstance(value, np.ndarray) and value.ndim > 0:
+        value = np.concatenate((self.data_dict[key], value), axis=-1)
+      
+      data_dict[key] = value
+    
+    return other.get_copy_with_data(data_dict)
+  
+  def get_frame_window(self, start, stop):
+    """
+    A NormalizedWorm of only frames start to stop (exclusive) of this one.
+    
+    The data of the new worm are views of the data of this one, and are
+    only sliced when first accessed. For a worm from from_cache they are 
+    thus not read from disk until they are used.
+    
+    """
+    def load_value(key):
+      value = self.data_dict[key]
+      
+      # The frames are along the last dimension, strings such as 
+      # EIGENWORM_PATH are the same for all frames
+      if isinstance(value, np.ndarray) and value.ndim > 0:
+        value = value[..., start:stop]
+      
+      return value
+    
+    nw = self.get_copy_with_data(LazyDataDict(self.data_dict.keys(), 
+                                              load_value))
+    
+    # e.g. the memory-mapped contour of a worm from from_cache
+    if self._contours is not None:
+      nw._contours = self._contours[..., start:stop]
+    
+    return nw
+  
+  def iter_frame_windows(self, n_frames_per_window=None, n_halo_frames=0):
+    """
+    Iterate over the video in windows of consecutive frames, so that 
+    long videos can be processed in parts.
+    
+    Parameters
+    ---------------------------------------
+    n_frames_per_window : int (optional)
+      The # of frames each window is for, the default being 
+      config.N_FRAMES_PER_WINDOW. The last window may be shorter.
+    n_halo_frames : int (optional)
+      The # of frames before and after each window that are also given,
+      for computations that look at neighboring frames. Windows at the
+      start and end of the video have a smaller halo.
+    
+    Returns
+    ---------------------------------------
+    An iterator of FrameWindow
+    
+    Notes
+    ---------------------------------------
+    Only the data of the current window is held for worms from 
+    from_cache, which are memory-mapped. Otherwise all data is already in 
+    memory and the windows are views of it.
+    
+    """
+    if n_frames_per_window is None:
+      n_frames_per_window = config.N_FRAMES_PER_WINDOW
+      
+    n_frames = self.num_frames
+    
+    for start in range(0, n_frames, n_frames_per_window):
+      stop = min(start + n_frames_per_window, n_frames)
+      
+      halo_start = max(start - n_halo_frames, 0)
+      halo_stop  = min(stop + n_halo_frames, n_frames)
+      
+      yield FrameWindow(self.get_frame_window(halo_start, halo_stop), 
+                        start, stop, halo_start, halo_stop)
+      
   def load_frame_code_descriptions(self):
     """
     Load the frame_codes descriptions, which are stored in a .csv file
@@ -348,21 +908,146 @@ class NormalizedWorm():
     
     
 
-  def load_normalized_blocks(self, blocks_path):
+  def load_normalized_blocks(self, blocks_path, failed_frames_file_path=None,
+                             n_processes=None):
     """ 
     Processes all the MatLab data "blocks" created from the raw 
     video into one coherent set of data.  This is a translation 
     of createObjectFromFiles from Jim's original code.
+    
+    Parameters
+    ---------------------------------------    
+    blocks_path: string
+      The folder with the normBlock1.mat ... normBlockN.mat files
+    failed_frames_file_path: string (optional)
+      The ..._failedFrames.mat file, which gives the error code of each 
+      frame that could not be segmented
+    n_processes: int (optional)
+      The # of processes reading the blocks, the default being the # of
+      processors. If 1 the blocks are read in this process.
         
     Notes
     ---------------------------------------    
-    From @MichaelCurrie: This appears to be the old way of doing this.
-    I'll hold off translating this "block" processor.  
-    I think norm_obj.mat actually maps directly to the structure I need.
+    Each normBlock<i> variable is a cell array holding the segmentation
+    status of each frame of the block (a string, see load_normalized_data)
+    followed by the values listed in NORM_BLOCK_FIELDS, with the frames 
+    along the last dimension. Every block but the last has the same # of 
+    frames (500 in the Schafer Lab code).
+    
+    The blocks are read in a pool of processes. As the first and the 
+    last block give the total # of frames, they are submitted first. Once
+    both have been read the arrays of data_dict are allocated, and every
+    block is copied into them as soon as it arrives, after which it is 
+    released. Only blocks that arrive before the first and the last one 
+    are held until then.
+    
+    Every value of a frame which was not segmented is NaN.
+    
+    failedFrames is expected to be [n_failed x 2], holding the (1 based)
+    frame number and the error code of each failed frame. Failed frames
+    that it doesn't list, or all failed frames if it is not given, get 
+    the frame code 0 (Unknown).
+    
+    As the blocks are read with multiple processes, on Windows this 
+    must be called from within an "if __name__ == '__main__':" block.
     
     """
-    pass
-
+    block_files = {}
+    for file_path in glob.glob(os.path.join(blocks_path, 'normBlock*.mat')):
+      match = re.match(r'normBlock(\d+)\.mat$', os.path.basename(file_path))
+      if match:
+        block_files[int(match.group(1))] = file_path
+        
+    n_blocks = len(block_files)
+    if n_blocks == 0:
+      raise Exception("No normBlock files found in: " + blocks_path)
+    if sorted(block_files) != list(range(1, n_blocks + 1)):
+      raise Exception("normBlock files are missing from: " + blocks_path)
+    
+    # The first and the last block are read first, see Notes
+    block_numbers = sorted(block_files, key=lambda x: x not in (1, n_blocks))
+    
+    if n_processes == 1:
+      executor = None
+      block_results = ((x, h__loadNormBlock(block_files[x], 'normBlock%d' % x))
+                       for x in block_numbers)
+    else:
+      executor = concurrent.futures.ProcessPoolExecutor(n_processes)
+      futures  = {executor.submit(h__loadNormBlock, block_files[x], 
+                                  'normBlock%d' % x): x for x in block_numbers}
+      
+      def h__iterCompletedBlocks():
+        # Each future is popped as it is handled, so that its block is 
+        # released once it has been copied
+        for future in concurrent.futures.as_completed(list(futures)):
+          yield futures.pop(future), future.result()
+          
+      block_results = h__iterCompletedBlocks()
+    
+    try:
+      data_dict = None
+      waiting_blocks = {}
+      for block_number, block in block_results:
+        if data_dict is None:
+          # Wait for both the first and the last block
+          waiting_blocks[block_number] = block
+          if 1 not in waiting_blocks or n_blocks not in waiting_blocks:
+            continue
+          
+          block_size = len(waiting_blocks[1][0])
+          n_frames   = block_size*(n_blocks - 1) + len(waiting_blocks[n_blocks][0])
+          
+          data_dict = {'segmentation_status': np.empty(n_frames, dtype='<U1')}
+          for key, shape in NORM_BLOCK_FIELDS:
+            data_dict[key] = np.empty(shape + (n_frames,))
+          
+          blocks_to_copy = list(waiting_blocks.items())
+          waiting_blocks = None
+        else:
+          blocks_to_copy = [(block_number, block)]
+        
+        for cur_number, (cur_status, cur_values) in blocks_to_copy:
+          start = block_size*(cur_number - 1)
+          end   = start + len(cur_status)
+          if cur_number != n_blocks and end - start != block_size:
+            raise Exception("normBlock%d has %d frames, rather than %d" % 
+                            (cur_number, end - start, block_size))
+          
+          data_dict['segmentation_status'][start:end] = cur_status
+          for (key, _), value in zip(NORM_BLOCK_FIELDS, cur_values):
+            data_dict[key][..., start:end] = value
+    finally:
+      if executor is not None:
+        executor.shutdown(cancel_futures=True)
+    
+    status = data_dict['segmentation_status']
+    
+    not_segmented = status != 's'
+    for key, _ in NORM_BLOCK_FIELDS:
+      data_dict[key][..., not_segmented] = np.NaN
+    
+    # see frame_codes.csv
+    frame_codes = np.ones(n_frames, dtype=int)
+    frame_codes[status == 'f'] = 0
+    frame_codes[status == 'm'] = 2
+    frame_codes[status == 'd'] = 3
+    if failed_frames_file_path is not None:
+      failed_frames = scipy.io.loadmat(failed_frames_file_path)['failedFrames']
+      failed_frames = np.reshape(failed_frames, (-1, 2)).astype(int)
+      frame_codes[failed_frames[:,0] - 1] = failed_frames[:,1]
+    
+    data_dict['frame_codes']    = frame_codes
+    data_dict['EIGENWORM_PATH'] = ''
+    data_dict['x'] = data_dict['skeletons'][:,0,:]
+    data_dict['y'] = data_dict['skeletons'][:,1,:]
+    
+    self.data_file = None
+    self.data_dict = data_dict
+    self._partition_cumsums = None
+    self._frame_runs = None
+    self._contours = None
+    
+    self.load_frame_code_descriptions()
 
   def rotate(self, theta_d):
     """   
@@ -527,17 +1212,15 @@ class NormalizedWorm():
       # as keys, and loaded matrices as values
       eigen_worms_file = scipy.io.loadmat(eigen_worm_file_path)
 
-      # TODO: turn this into a numpy array, probably
-      # TODO: and possibly extract other things of value from 
+      # TODO: possibly extract other things of value from 
       #       eigen_worms_file
-      #self.eigen_worms = eigen_worms_file.values() # DEBUG: I think this is wrong
-
+      
       # DEBUG: another way to load eigenworms:
       #h = h5py.File(uconfig.EIGENWORM_PATH,'r')
       #eigen_worms = h['eigenWorms'].value
 
-
-      self.eigen_worms = eigen_worms_file.values() # DEBUG: I think this is wrong
+      # [48 x 7], one eigenworm per column
+      self.eigen_worms = eigen_worms_file['eigenWorms']
 
   @property
   def num_frames(self): 
@@ -576,6 +1259,53 @@ class NormalizedWorm():
     return (np.nanmin(d[dimension,0,:]), 
             np.nanmax(d[dimension,1,:]))
 
+  @property
+  def frame_runs(self):
+    """
+    The runs of frames with a skeleton. This is computed once, and is used
+    by the feature code that needs to know which frames have a skeleton 
+    (Duration, get_worm_kinks), rather than each finding its own NaN 
+    values.
+    
+    Returns
+    ---------------------------------------
+    A dictionary of FrameRuns, with keys:
+      'skeleton' - frames with a skeleton, i.e. not all NaN
+    
+    Notes
+    ---------------------------------------
+    A frame whose skeleton is only partly NaN counts as having a skeleton.
+    The velocity and path curvature code instead treat a frame as valid 
+    based on its body angle, so they find their own valid frames.
+    
+    """
+    if self._frame_runs is None:
+      # [49 x 2 x n_frames] => [n_frames]
+      has_skeleton = ~np.all(np.isnan(self.data_dict['skeletons']), axis=(0,1))
+      
+      self._frame_runs = {'skeleton': FrameRuns(has_skeleton)}
+    
+    return self._frame_runs
+
+  @property
+  def contours(self):
+    """ 
+      Return the approximate worm contour, derived from data, 
+      shape (96, 2, n)
+      NOTE: The first and last points are duplicates, so we omit
+            those on the second set. We also reverse the contour so that
+            it encompasses an "out and back" contour
+      
+      This is built once, or, for data from from_cache, memory-mapped 
+      from the cache.
+    """
+    if self._contours is None:
+      vc  = self.data_dict['vulva_contours']
+      nvc = self.data_dict['non_vulva_contours']
+      self._contours = np.concatenate((vc, nvc[-2:0:-1]))
+        
+    return self._contours
+
   @property
   def contour_x(self):
     """ 
@@ -583,16 +1313,17 @@ class NormalizedWorm():
       NOTE: The first and last points are duplicates, so we omit
             those on the second set. We also reverse the contour so that
             it encompasses an "out and back" contour
+      
+      This is a view of contours.
     """
-    vc  = self.data_dict['vulva_contours']
-    nvc = self.data_dict['non_vulva_contours']
-    return np.concatenate((vc[:,0,:], nvc[-2:0:-1,0,:]))    
+    return self.contours[:,0,:]
 
   @property
   def contour_y(self):
-    vc  = self.data_dict['vulva_contours']
-    nvc = self.data_dict['non_vulva_contours']
-    return np.concatenate((vc[:,1,:], nvc[-2:0:-1,1,:]))    
+    """ 
+      The y coordinates of the contour, see contour_x
+    """
+    return self.contours[:,1,:]
 
   @property
   def skeleton_x(self):
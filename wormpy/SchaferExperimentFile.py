@@ -75,8 +75,8 @@ class SchaferExperimentFile:
     else:
       worm_file = h5py.File(worm_file_path, 'r')
       
-      x_data = worm_file["worm"]["posture"]["skeleton"]["x"].value
-      y_data = worm_file["worm"]["posture"]["skeleton"]["y"].value
+      x_data = worm_file["worm"]["posture"]["skeleton"]["x"][()]
+      y_data = worm_file["worm"]["posture"]["skeleton"]["y"][()]
 
       worm_file.close()
 
@@ -86,18 +86,11 @@ class SchaferExperimentFile:
   def combine_skeleton_axes(self, x_data, y_data):
     """ We want to "concatenate" the values of the skeletons_x and 
         skeletons_y 2D arrays into a 3D array
-        First let's create a temporary python list of numpy arrays
+        x_data and y_data have shape (n, 49), the result has 
+        shape (n, 49, 2)
         
     """
-    skeletons_TEMP = []
-    
-    # Loop over all frames; frames are the first dimension of skeletons_x
-    for frame_index in range(x_data.shape[0]):
-        skeletons_TEMP.append(np.column_stack((x_data[frame_index], 
-                                              y_data[frame_index])))
-
-    # Return our list as a numpy array
-    return np.array(skeletons_TEMP)
+    return np.stack((x_data, y_data), axis=2)
 
   def skeletons_x(self):
     """ Returns a numpy array of shape (23135, 49) with just X coordinate
@@ -117,7 +110,7 @@ class SchaferExperimentFile:
         returned shape is approx (23000) and gives True if frame 
         was dropped in experiment file
     """
-    return np.isnan(list(frame[0] for frame in self.skeletons_x()))
+    return np.isnan(self.skeletons[:,0,0])
 
 
   def interpolate_dropped_frames(self):
@@ -175,7 +168,7 @@ class SchaferExperimentFile:
 
     # Create a new instance, with the interpolated results    
     w = SchaferExperimentFile()
-    w.combine_skeleton_axes(x_data, y_data)
+    w.skeletons = w.combine_skeleton_axes(x_data, y_data)
     
     return w
      
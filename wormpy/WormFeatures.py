@@ -37,6 +37,7 @@ from wormpy import feature_helpers
 from . import path_features
 from . import posture_features
 from . import utils
+from .EventFinder import EventSimpleStructure
 
 #import pdb
 
@@ -81,7 +82,7 @@ class WormMorphology(object):
     # part of the worm the head, midbody and tail.
     #
     # shape of resulting arrays are (2, n)
-    width_dict = {k: np.mean(nw.get_partition(k, 'skeletons'), 0) \
+    width_dict = {k: nw.get_partition_mean(k, 'skeletons') \
                   for k in ('head', 'midbody', 'tail')}
             
     #Make named tuple instead of dict
@@ -168,8 +169,7 @@ class WormLocomotion():
 
     self.velocity = feature_helpers.get_worm_velocity(nw)
 
-    midbody_distance = \
-      abs(self.velocity['midbody']['speed'] / config.FPS)
+    midbody_speed = self.velocity['midbody']['speed']
     
     # DEBUG
     #feature_helpers.write_to_CSV(
@@ -182,7 +182,7 @@ class WormLocomotion():
     #      )
 
     self.motion_codes = \
-      feature_helpers.get_motion_codes(midbody_distance, 
+      feature_helpers.get_motion_codes(midbody_speed, 
                                        nw.data_dict['lengths'])
   
     self.motion_mode = 0
@@ -264,16 +264,11 @@ class WormPosture():
     # *** 1. Bends *** DONE
     self.bends = posture_features.Bends(nw)
       
-    # *** 2. Eccentricity & Orientation *** DONE, SLOW
-    #This has not been optimized, that Matlab version has
-    #NOTE: This is VERY slow, leaving commented for now
-    #self.eccentricity,self.orientation = \
-    #   posture_features.get_eccentricity_and_orientation(nw.contour_x,nw.contour_y)
+    # *** 2. Eccentricity & Orientation *** DONE
+    self.eccentricity,self.orientation = \
+       posture_features.get_eccentricity_and_orientation(nw.contour_x,nw.contour_y)
 
-    
-    #Temp input for next function ...
-    self.orientation = np.zeros(nw.skeleton_x.shape[1])
-    # *** 3. Amplitude, Wavelengths, TrackLength, Amplitude Ratio *** NOT DONE
+    # *** 3. Amplitude, Wavelengths, TrackLength, Amplitude Ratio *** DONE
     amp_wave_track = posture_features.get_amplitude_and_wavelength(
                           self.orientation,
                           nw.skeleton_x,
@@ -282,12 +277,13 @@ class WormPosture():
 
     self.amplitude_max        = amp_wave_track.amplitude_max
     self.amplitude_ratio      = amp_wave_track.amplitude_ratio 
-    #self.primary_wavelength   = amp_wave_track.p_wavelength
-    #self.secondary_wavelength = amp_wave_track.s_wavelength  
+    self.primary_wavelength   = amp_wave_track.primary_wavelength
+    self.secondary_wavelength = amp_wave_track.secondary_wavelength  
     self.track_length         = amp_wave_track.track_length
 
     # *** 4. Kinks *** DONE
-    self.kinks = posture_features.get_worm_kinks(nw.data_dict['angles'])
+    self.kinks = posture_features.get_worm_kinks(nw.data_dict['angles'],
+                                          nw.frame_runs['skeleton'].mask)
         
     
 
@@ -296,7 +292,7 @@ class WormPosture():
 
 
     # *** 6. Directions *** DONE
-    self.directions = posture_features.Directions(nw.skeleton_x,nw.skeleton_y,nw.worm_partitions)
+    self.directions = posture_features.Directions(nw)
 
     # *** 7. Skeleton *** DONE
     # (already in morphology, but Schafer Lab put it here too)
@@ -391,7 +387,8 @@ class WormPath():
        
     #Curvature (Done)
     #---------------------------------------------------
-    self.curvature = path_features.worm_path_curvature(sx,sy,config.FPS,config.VENTRAL_MODE)
+    self.curvature = path_features.worm_path_curvature(sx,sy,config.FPS,config.VENTRAL_MODE,
+                                                       nw.get_partition_mean('all'))
 
   #TODO: Move to class in path_features
   @classmethod
@@ -425,6 +422,344 @@ class WormPath():
     #self.coordinates == other.cordinates #and \
     #self.curvature == other.curvature
     
+def get_frame_features_halo():
+  """
+  The # of frames needed on each side of a frame window so that the 
+  features of WormFrameFeatures in the window are the same as if they 
+  were computed for the whole video.
+  
+  Notes
+  ---------------------------------------
+  The velocity of a frame is computed from frames up to 
+  frames_per_sample - 2 frames away (see h__getVelocityIndices), 
+  frames_per_sample being largest for config.BODY_DIFF. The path 
+  curvature also uses the velocity of the frame frames_per_sample 
+  frames ahead, and is only computed for frames that are at least 
+  frames_per_sample + 1 frames from the end (see worm_path_curvature).
+  
+  """
+  frames_per_sample = feature_helpers.get_frames_per_sample(config.BODY_DIFF)
+  
+  velocity_halo  = frames_per_sample - 2
+  curvature_halo = frames_per_sample + 1
+  
+  return velocity_halo + curvature_halo
+
+def h__getFrameFeatures(nw):
+  """
+  Compute the features of WormFrameFeatures, using the same functions 
+  as WormMorphology, WormLocomotion, WormPosture and WormPath.
+  
+  Returns
+  ---------------------------------------
+  A dictionary of the features, with the frames along the last dimension
+  of each
+  
+  """
+  features = {}
+  
+  morphology = WormMorphology(nw)
+  features['length']           = morphology.length
+  features['area']             = morphology.area
+  features['area_per_length']  = morphology.area_per_length
+  features['width_per_length'] = morphology.width_per_length
+  for key in ('head', 'midbody', 'tail'):
+    features[key + '_width'] = getattr(morphology.width, key)
+  
+  velocity = feature_helpers.get_worm_velocity(nw)
+  for key, value in velocity.items():
+    features[key + '_speed']     = value['speed']
+    features[key + '_direction'] = value['direction']
+  
+  features['eccentricity'], orientation = \
+    posture_features.get_eccentricity_and_orientation(nw.contour_x,nw.contour_y)
+  features['orientation'] = orientation
+  
+  amp_wave_track = posture_features.get_amplitude_and_wavelength(
+                          orientation,
+                          nw.skeleton_x,
+                          nw.skeleton_y,
+                          nw.data_dict['lengths'])
+  for key in ('amplitude_max', 'amplitude_ratio', 'primary_wavelength', 
+              'secondary_wavelength', 'track_length'):
+    features[key] = getattr(amp_wave_track, key)
+    
+  features['kinks'] = posture_features.get_worm_kinks(nw.data_dict['angles'],
+                                            nw.frame_runs['skeleton'].mask)
+  
+  directions = posture_features.Directions(nw)
+  for key in ('tail2head', 'head', 'tail'):
+    features[key + '_direction_of_worm'] = getattr(directions, key)
+  
+  features['curvature'] = path_features.worm_path_curvature(nw.skeleton_x, 
+                              nw.skeleton_y, config.FPS, config.VENTRAL_MODE,
+                              nw.get_partition_mean('all'))
+  
+  return features
+
+class WormFrameFeatures():
+  """
+  The features which are computed for each frame from only that frame
+  and the frames near it, computed window by window so that the memory 
+  used does not grow with the length of the video.
+  
+  Attributes
+  ---------------------------------------
+  Each is [n_frames], or [2 x n_frames] for the widths (see 
+  WormMorphology):
+  
+  length, area, area_per_length, width_per_length, 
+  head_width, midbody_width, tail_width - as in WormMorphology
+  
+  head_tip_speed, head_tip_direction, head_speed, ..., tail_tip_direction
+    - the velocity of WormLocomotion
+  
+  eccentricity, orientation, amplitude_max, amplitude_ratio, 
+  primary_wavelength, secondary_wavelength, track_length, kinks - as in
+  WormPosture
+  
+  tail2head_direction_of_worm, head_direction_of_worm, 
+  tail_direction_of_worm - the directions of WormPosture
+  
+  curvature - as in WormPath
+  
+  """
+  
+  def __init__(self, nw, n_frames_per_window=None):
+    """
+    Parameters
+    ---------------------------------------
+    nw : NormalizedWorm
+      To keep the memory used constant, this should be from 
+      NormalizedWorm.from_cache
+    n_frames_per_window : int (optional)
+      See NormalizedWorm.iter_frame_windows
+    
+    Notes
+    ---------------------------------------
+    Each window is given a halo of frames (see get_frame_features_halo) 
+    so that the values are identical to computing the features for the
+    whole video at once.
+    
+    """
+    features = None
+    n_frames = nw.num_frames
+    
+    for window in nw.iter_frame_windows(n_frames_per_window, 
+                                        get_frame_features_halo()):
+      window_features = h__getFrameFeatures(window.nw)
+      
+      if features is None:
+        features = {k: np.empty(v.shape[:-1] + (n_frames,), dtype=v.dtype)
+                    for k, v in window_features.items()}
+      
+      for key, value in window_features.items():
+        features[key][..., window.start:window.stop] = value[..., window.core]
+    
+    # A worm without frames has no windows
+    if features is None:
+      features = h__getFrameFeatures(nw)
+    
+    for key, value in features.items():
+      setattr(self, key, value)
+    
+  def __repr__(self):
+    return utils.print_object(self)
+
+def h__growFrameBuffer(buffer, n_frames, value):
+  """
+  Make sure that a buffer of frames, along its last dimension, has room 
+  for n_frames frames.
+  
+  Parameters
+  ---------------------------------------
+  buffer : numpy array, or None for a new buffer
+  n_frames : int
+  value : numpy array
+    Gives the shape (but for the frames) and the dtype of a new buffer
+  
+  Returns
+  ---------------------------------------
+  buffer, or a larger copy of it. Its size at least doubles so that 
+  growing it one block at a time takes linear time overall.
+  
+  """
+  if buffer is not None and buffer.shape[-1] >= n_frames:
+    return buffer
+  
+  n_old_frames = 0 if buffer is None else buffer.shape[-1]
+  
+  new_buffer = np.empty(value.shape[:-1] + (max(n_frames, 2*n_old_frames),),
+                        dtype=value.dtype)
+  if buffer is not None:
+    new_buffer[..., :n_old_frames] = buffer
+  
+  return new_buffer
+
+class WormFeaturesUpdater():
+  """
+  Keeps features up to date as frames are appended to a recording, e.g. 
+  while tracking, without computing them again for the whole recording.
+  
+  After each call to append the features are the same as if they had 
+  been computed for all of the frames so far, except for the Duration, 
+  see path_features.DurationAccumulator.
+  
+  Attributes
+  ---------------------------------------
+  n_frames : int
+    The # of frames appended so far
+  frame_features : WormFrameFeatures
+  motion_codes : dict
+    see feature_helpers.get_motion_codes
+  duration : path_features.Duration
+  
+  The arrays of frame_features and motion_codes['mode'] are views of 
+  buffers with room for more frames, so that each append only writes 
+  the frames that changed. They are replaced on each append, and a 
+  previous view may see the changed frames.
+  
+  """
+  
+  def __init__(self):
+    self.n_frames       = 0
+    self.frame_features = None
+    self.motion_codes   = None
+    
+    # The frame features before this frame will not change when frames are
+    # appended, as they have a full halo of frames after them
+    self._n_final_frames = 0
+    
+    # The frames needed to update the frame features that are not final, 
+    # and the first frame of them
+    self._nw_tail    = None
+    self._tail_start = 0
+    
+    # The motion events before this frame are final, see 
+    # feature_helpers.get_motion_codes_split_frame
+    self._motion_split_frame = 0
+    
+    self._duration_accumulator = None
+    
+    # The arrays holding the per frame features and the motion mode, which
+    # have room for more frames, see h__growFrameBuffer
+    self._buffers = {}
+    
+  def append(self, nw):
+    """
+    Add frames to the end of the recording and update the features
+    
+    Parameters
+    ---------------------------------------
+    nw : NormalizedWorm
+      The new frames
+    
+    """
+    n_halo_frames = get_frame_features_halo()
+    
+    if self._nw_tail is None:
+      nw_tail = nw
+    else:
+      nw_tail = self._nw_tail.concatenate_frames(nw)
+    
+    n_frames = self.n_frames + nw.num_frames
+    
+    # Per frame features, from the first frame that is not final
+    #----------------------------------------------------------------
+    # The frames of nw_tail to keep
+    new_I = slice(self._n_final_frames - self._tail_start, None)
+    
+    tail_features = h__getFrameFeatures(nw_tail)
+    
+    if self.frame_features is None:
+      self.frame_features = WormFrameFeatures.__new__(WormFrameFeatures)
+    
+    for key, value in tail_features.items():
+      buffer = h__growFrameBuffer(self._buffers.get(key), n_frames, value)
+      buffer[..., self._n_final_frames:n_frames] = value[..., new_I]
+      
+      self._buffers[key] = buffer
+      setattr(self.frame_features, key, buffer[..., :n_frames])
+    
+    self._n_final_frames = max(n_frames - n_halo_frames, 0)
+    
+    # Keep the halo before the frames that are not final
+    self._tail_start = max(self._n_final_frames - n_halo_frames, 0)
+    self._nw_tail    = nw_tail.get_frame_window(
+                         self._tail_start - (n_frames - nw_tail.num_frames),
+                         nw_tail.num_frames)
+    
+    self.n_frames = n_frames
+    
+    # Motion codes, from the first event that is not final
+    #----------------------------------------------------------------
+    self.h__updateMotionCodes()
+    
+    # Duration
+    #----------------------------------------------------------------
+    if self._duration_accumulator is None:
+      self._duration_accumulator = \
+        path_features.DurationAccumulator(nw.worm_partitions, config.FPS)
+    
+    self._duration_accumulator.append(nw.skeleton_x, nw.skeleton_y, 
+                                      nw.data_dict['widths'])
+  
+  def h__updateMotionCodes(self):
+    """
+    Find the motion events again from self._motion_split_frame, then move 
+    the split frame as far forward as possible.
+    """
+    split_frame   = self._motion_split_frame
+    midbody_speed = self.frame_features.midbody_speed
+    lengths       = self.frame_features.length
+    
+    tail_motion_codes = \
+      feature_helpers.get_motion_codes(midbody_speed[split_frame:], 
+                                       lengths[split_frame:])
+    
+    tail_mode = tail_motion_codes['mode']
+    mode = h__growFrameBuffer(self._buffers.get('mode'), self.n_frames, 
+                              tail_mode)
+    mode[split_frame:self.n_frames] = tail_mode
+    self._buffers['mode'] = mode
+    
+    if self.motion_codes is None:
+      self.motion_codes = tail_motion_codes
+      self.motion_codes['mode'] = mode[:self.n_frames]
+    else:
+      motion_codes = {}
+      motion_codes['mode'] = mode[:self.n_frames]
+      
+      for key, value in tail_motion_codes.items():
+        if key == 'mode':
+          continue
+        
+        # The events which ended before the split frame
+        old_events = self.motion_codes[key]
+        is_final   = old_events.end_Is < split_frame
+        
+        motion_codes[key] = EventSimpleStructure(
+          np.concatenate((old_events.start_Is[is_final], 
+                          value.start_Is + split_frame)),
+          np.concatenate((old_events.end_Is[is_final], 
+                          value.end_Is + split_frame)))
+        
+      self.motion_codes = motion_codes
+      
+    new_split_frame = feature_helpers.get_motion_codes_split_frame(
+                        midbody_speed[split_frame:], lengths[split_frame:],
+                        self._n_final_frames - split_frame)
+    
+    if new_split_frame is not None:
+      self._motion_split_frame = split_frame + new_split_frame
+  
+  @property
+  def duration(self):
+    return self._duration_accumulator.get_duration()
+  
+  def __repr__(self):
+    return utils.print_object(self)
+
 class WormFeatures:
   """ 
     WormFeatures: takes as input a NormalizedWorm instance, and
@@ -436,10 +771,27 @@ class WormFeatures:
        (via the from_disk method)
     
   """
-  def __init__(self, nw):
+  def __init__(self, nw, windowed=False, n_frames_per_window=None):
+    """
+    Parameters
+    ---------------------------------------
+    nw : NormalizedWorm
+    windowed : bool (optional)
+      If True only the per-frame features are computed, window by window,
+      and are stored in frame_features (a WormFrameFeatures) rather than 
+      in morphology, locomotion and posture. The memory used then does
+      not grow with the length of the video.
+    n_frames_per_window : int (optional)
+      See WormFrameFeatures, only used if windowed is True
+    
+    """
 
     if nw is None:
       return
+    
+    if windowed:
+      self.frame_features = WormFrameFeatures(nw, n_frames_per_window)
+      return
 
     self.morphology = WormMorphology(nw)
     self.locomotion = WormLocomotion(nw)
@@ -32,6 +32,10 @@ MIMIC_OLD_BEHAVIOUR = False
 FPS = 20                 
 VENTRAL_MODE = 0   # DEBUG: might not need to be here but used in Path code
 
+# The default # of frames in each window of 
+# NormalizedWorm.iter_frame_windows, not counting the halo
+N_FRAMES_PER_WINDOW = 2000
+
 
 
 """ Posture Features """
@@ -42,11 +46,29 @@ KINK_LENGTH_THRESHOLD_PCT = 1/12 #This the fraction of the worm length
 
 
     
+# How the moments of the filled contour are computed for eccentricity
+# and orientation:
+# 'grid'    - estimated by filling the contour with a grid of points, as 
+#             in the Schafer Lab code (see N_ECCENTRICITY)
+# 'polygon' - exact area and second central moments from the contour 
+#             vertices (Green's theorem). Frames whose contour crosses 
+#             itself (e.g. coiled worms) or encloses almost no area fall 
+#             back to the grid method.
+ECCENTRICITY_METHOD = 'grid'
+
+ECCENTRICITY_MIN_AREA_FRACTION = 1e-3 # In 'polygon' mode, frames whose 
+# enclosed area is less than this fraction of the area of the contour's 
+# bounding box use the grid method instead.
+
 N_ECCENTRICITY = 50 # Grid size for estimating eccentricity, this is the
 # max # of points that will fill the wide dimension.
 # (scalar) The # of points to place in the long dimension. More points
 # gives a more accurate estimate of the ellipse but increases
 # the calculation time.
+
+N_ECCENTRICITY_FRAMES_PER_BLOCK = 500 # The # of frames whose grids are 
+# filled at once when estimating eccentricity. Memory use scales with 
+# N_ECCENTRICITY**2 times this value.
  
 
 POSTURE_AMPLITURE_AND_WAVELENGTH = { \
@@ -63,6 +85,10 @@ POSTURE_AMPLITURE_AND_WAVELENGTH['HALF_N_FFT'] = \
 # used in get_velocity:
 TIP_DIFF  = 0.25
 BODY_DIFF = 0.5
+# The # of velocity index results to hold on to. Each call to 
+# get_worm_velocity needs 2 (one for TIP_DIFF and one for BODY_DIFF),
+# which the path curvature also reuses.
+N_VELOCITY_INDICES_CACHED = 4
 
 
 # Used in get_motion_codes:
@@ -13,7 +13,6 @@ from __future__ import division #distance/time compute_velocity
 
 import warnings
 import numpy as np
-from itertools import groupby
 
 #np.seterr(all='raise')           # DEBUG
 
@@ -114,82 +113,89 @@ def interpolate_with_threshold(array, threshold=None):
 
   Parameters
   ---------------------------------------
-  array: 1-dimensional numpy array
-    The array to be interpolated
+  array: numpy array
+    The array to be interpolated, either 1-dimensional or with the frames
+    along the last dimension, e.g. [49 x n_frames] or [49 x 2 x n_frames]. 
+    In the latter case each point is interpolated over the frames 
+    independently of the others.
   threshold: int
     The maximum size of a contiguous set of missing data points
     that gets interpolated.  Sets larger than this are left as NaNs.
-    If threshold is set to NaN then all points are interpolated.
+    If threshold is set to None then all points are interpolated.
   
   Returns
   ---------------------------------------
   numpy array with the values interpolated
   
-  """
-
-  """
-  # (SKIP THIS, THIS IS FOR THE N-DIMENSIONAL CASE WHICH WE
-  # HAVE NOT IMPLEMENTED YET)
-    # Check that any frames with NaN in at least one dimension must
-    # have it in all:
-    frames_with_at_least_one_NaN = np.all(np.isnan(array), frame_dimension)
-    frames_with_no_NaNs          = np.all(~np.isnan(array), frame_dimension)
-    # check that each frame is either True for one of these arrays or 
-    # the other but not both.
-    assert(np.logical_xor(frames_with_at_least_one_NaN, frames_with_no_NaNs))
-    frame_dropped = frames_with_at_least_one_NaN
-
+  Notes
+  ---------------------------------------
+  Like np.interp, missing data before the first (or after the last) valid 
+  data point is filled with that data point. Points without any valid 
+  data are left as NaNs.
+  
   """
   
-  assert(threshold == None or threshold >= 0)
+  assert(threshold is None or threshold >= 0)
   
   if(threshold == 0):  # everything gets left as NaN
     return array
   
   # Say array = [10, 12, 15, nan, 17, nan, nan, nan, -5]
-  # Then np.isnan(array) = 
-  # [False, False, False, True, False True, True, True, False]
-  # Let's obtain the "x-coordinates" of the NaN entries.
-  # e.g. [3, 5, 6, 7]
-  x = np.flatnonzero(np.isnan(array))
-  
-  # (If we weren't using a threshold and just interpolating all NaNs, 
-  # we could skip the next four lines.)
-  if(threshold != None):
-    # Group these together using a fancy trick from 
-    # http://stackoverflow.com/questions/2154249/, since
-    # the lambda function x:x[0]-x[1] on an enumerated list will
-    # group consecutive integers together
-    # e.g. [[(0, 3)], [(1, 5), (2, 6), (3, 7)]]
-    x_grouped = [list(group) for key, group in groupby(enumerate(x), 
-                                                       lambda i:i[0]-i[1])]
-    
-    # We want to know the first element from each "run", and the run's length
-    # e.g. [(3, 1), (5, 3)]
-    x_runs = [(i[0][1], len(i)) for i in x_grouped]
-    
-    # We need only interpolate on runs of length <= threshold
-    # e.g. if threshold = 2, then we have only [(3, 1)]
-    x_runs = [i for i in x_runs if i[1] <= threshold]
-  
-    # now expand the remaining runs
-    # e.g. if threshold was 5, then x_runs would be [(3,1), (5,3)] so
-    #      x would be [3, 5, 6, 7]
-    # this give us the x-coordinates of the values to be interpolated:
-    x = np.concatenate([(i[0] + list(range(i[1]))) for i in x_runs])
+  # Then we'd like, for each frame, the index of the valid frame before it
+  # [0, 1, 2, 2, 4, 4, 4, 4, 8] and the index of the valid frame after it
+  # [0, 1, 2, 4, 4, 8, 8, 8, 8]. The difference tells us the length of 
+  # each run of NaNs, and the two are the points we interpolate between.
+  #--------------------------------------------------------------------
+  array    = np.asarray(array)
+  n_frames = array.shape[-1]
+  data     = array.reshape((-1, n_frames))
+  
+  is_nan = np.isnan(data)
+  if not np.any(is_nan):
+    return np.copy(array)
+  
+  frame_I = np.arange(n_frames)
+  
+  # Frames before the first valid frame get -1, after the last get n_frames
+  prev_I = np.maximum.accumulate(np.where(is_nan, -1, frame_I), axis=1)
+  next_I = np.minimum.accumulate(np.where(is_nan, n_frames, frame_I)[:,::-1], 
+                                 axis=1)[:,::-1]
+
+  run_lengths = next_I - prev_I - 1
+  
+  # We need only interpolate on runs of length <= threshold, in rows which
+  # have at least one valid frame to interpolate from
+  fill_mask = is_nan & (next_I - prev_I <= n_frames)
+  if(threshold is not None):
+    fill_mask &= run_lengths <= threshold
+  
+  row_I, frame_I = np.nonzero(fill_mask)
+  prev_I = prev_I[row_I, frame_I]
+  next_I = next_I[row_I, frame_I]
+  
+  # On the edges, there is only one frame to use
+  at_start = prev_I < 0
+  at_end   = next_I >= n_frames
+  prev_I[at_start] = next_I[at_start]
+  next_I[at_end]   = prev_I[at_end]
+  
+  prev_values = data[row_I, prev_I]
+  next_values = data[row_I, next_I]
+  
+  # Interpolate the same way np.interp does
+  is_between = prev_I != next_I
+  fill_values = prev_values.astype(float)
+  slopes = (next_values[is_between] - prev_values[is_between]) / \
+           (next_I[is_between] - prev_I[is_between])
+  fill_values[is_between] += slopes * (frame_I[is_between] - prev_I[is_between])
   
-  # The x-coordinates of the data points, must be increasing.
-  xp = np.flatnonzero(~np.isnan(array))
-  # The y-coordinates of the data points, same length as xp
-  yp = array[~np.isnan(array)]
-
   # Use a new array so we don't modify the original array passed to us
-  new_array = np.copy(array)
+  new_array = np.copy(data)
   
   # Place the interpolated values into the array
-  new_array[x] = np.interp(x, xp, yp)  
+  new_array[row_I, frame_I] = fill_values
   
-  return new_array
+  return new_array.reshape(array.shape)
 
 
 
@@ -208,16 +214,16 @@ def get_motion_codes(midbody_speed, skeleton_lengths):
   Parameters
   ---------------------------------------
   midbody_speed: numpy array 1 x n_frames
-    from locomotion.velocity.midbody.speed / config.FPS
+    from locomotion.velocity.midbody.speed
   skeleton_lengths: numpy array 1 x n_frames
 
   Returns
   ---------------------------------------
   The locomotion events; a dict (called locally all_events_dict) 
   with event fields:
-    forward  - (event) forward locomotion
-    paused   - (event) no locomotion (the worm is paused)
-    backward - (event) backward locomotion
+    forward  - (EventSimpleStructure) forward locomotion
+    paused   - (EventSimpleStructure) no locomotion (the worm is paused)
+    backward - (EventSimpleStructure) backward locomotion
     mode     = [1 x num_frames] the locomotion mode:
                -1 = backward locomotion
                 0 = no locomotion (the worm is paused)
@@ -227,6 +233,55 @@ def get_motion_codes(midbody_speed, skeleton_lengths):
   # Initialize the worm speed and video frames.
   num_frames = len(midbody_speed)
   
+  frame_values = {'forward': 1, 'backward': -1, 'paused': 0}
+  
+  ef, motion_types, min_speeds, max_speeds, min_distances = \
+    h__getMotionEventFinder(midbody_speed, skeleton_lengths)
+  
+  # This is the dictionary this function will return.  Keys will be:
+  # 
+  all_events_dict = {}
+
+  # Start with a blank numpy array, full of NaNs: 
+  all_events_dict['mode'] = np.zeros(num_frames, dtype='float') * np.NaN
+
+  # Determine when each event type occurred, all at once
+  all_frames_temp = \
+    ef.get_state_events(midbody_speed, min_speeds, max_speeds,
+                        min_sum_thresholds=min_distances)
+  
+  for motion_type, frames_temp in zip(motion_types, all_frames_temp):
+    # Obtain only events entirely before the num_frames intervals
+    mask = frames_temp.get_event_mask(num_frames)
+
+    # Assign event type to relevant frames of all_events_dict['mode']
+    all_events_dict['mode'][mask] = frame_values[motion_type]
+
+    # TODO: Take the start and stop indices and convert them to the 
+    # structure used in the feature files, once EventOutputStructure 
+    # is translated
+    #m_event = EventOutputStructure(frames_temp, distance_per_frame)
+    #all_events_dict[motion_type] = m_event.get_feature_struct()
+    all_events_dict[motion_type] = frames_temp
+  
+  return all_events_dict
+
+
+def h__getMotionEventFinder(midbody_speed, skeleton_lengths):
+  """
+  The EventFinder and the thresholds of each motion type that are used by
+  get_motion_codes
+  
+  Returns
+  ---------------------------------------
+  (ef, motion_types, min_speeds, max_speeds, min_distances)
+    ef : EventFinder
+    motion_types : ['forward', 'backward', 'paused']
+    min_speeds, max_speeds, min_distances : list
+      The thresholds of each motion type, see EventFinder.get_state_events
+  
+  """
+  
   # Compute the midbody's "instantaneous" distance travelled at each frame, 
   # distance per second / (frames per second) = distance per frame
   distance_per_frame = abs(midbody_speed / config.FPS)
@@ -259,7 +314,6 @@ def get_motion_codes(midbody_speed, skeleton_lengths):
   max_paused_speed     = worm_pause_threshold
 
   # Note that there is no maximum forward speed nor minimum backward speed.
-  frame_values = {'forward': 1, 'backward': -1, 'paused': 0}
   min_speeds   = {'forward': min_forward_speed, 
                   'backward': [], 
                   'paused': min_paused_speed}
@@ -281,43 +335,97 @@ def get_motion_codes(midbody_speed, skeleton_lengths):
   worm_event_min_interframes_threshold = \
     config.FPS * config.EVENT_MIN_INTER_FRAMES_THRESHOLD
   
-  # This is the dictionary this function will return.  Keys will be:
-  # 
-  all_events_dict = {}
-
-  # Start with a blank numpy array, full of NaNs: 
-  all_events_dict['mode'] = np.zeros(num_frames, dtype='float') * np.NaN
-
-  for motion_type in frame_values:
-    # Determine when the event type occurred
-    ef = EventFinder()
-
-    ef.include_at_thr       = True
-    ef.minum_frames_thr     = worm_event_frames_threshold
-    ef.min_sum_thr          = min_distance[motion_type]
-    ef.include_at_sum_thr   = True
-    ef.data_for_sum_thr     = distance_per_frame
-    ef.min_inter_frames_thr = worm_event_min_interframes_threshold
+  motion_types = ['forward', 'backward', 'paused']
+  
+  ef = EventFinder()
 
-    
-    frames_temp = ef.get_events(midbody_speed,
-                                min_speeds[motion_type],
-                                max_speeds[motion_type])
+  ef.include_at_threshold       = True
+  ef.min_frames_threshold       = worm_event_frames_threshold
+  ef.include_at_sum_threshold   = True
+  ef.data_for_sum_threshold     = distance_per_frame
+  ef.min_inter_frames_threshold = worm_event_min_interframes_threshold
 
-    """  DEBUG: @MichaelCurrie: code not ready yet!
-    # Obtain only events entirely before the num_frames intervals
-    mask = frames_temp.get_event_mask(num_frames)
+  return (ef, motion_types, 
+          [min_speeds[x] for x in motion_types],
+          [max_speeds[x] for x in motion_types],
+          [min_distance[x] for x in motion_types])
 
-    # Assign event type to relevant frames of all_events_dict['mode']
-    all_events_dict['mode'][mask] = frame_values[motion_type]
 
-    # Take the start and stop indices and convert them to the structure
-    # used in the feature files
-    m_event = EventOutputStructure(frames_temp, distance_per_frame)
-    all_events_dict[motion_type] = m_event.get_feature_struct()
-    """
+def get_motion_codes_split_frame(midbody_speed, skeleton_lengths, 
+                                 n_final_frames):
+  """
+  Find the last frame at which the motion codes can be split, i.e. where
+  the events before the frame do not depend on the data after it, so that
+  when frames are appended only the events from the split frame on need
+  to be found again:
   
-  return all_events_dict
+    get_motion_codes(midbody_speed[split_frame:], 
+                     skeleton_lengths[split_frame:])
+  
+  gives the same events (offset by split_frame) as get_motion_codes on all
+  of the data, for every event starting after split_frame. 
+  
+  Parameters
+  ---------------------------------------
+  midbody_speed : [n_frames]
+  skeleton_lengths : [n_frames]
+  n_final_frames : int
+    The # of frames of midbody_speed that will not change when frames are
+    appended (the speed of the last frames depends on the following ones)
+  
+  Returns
+  ---------------------------------------
+  split_frame : int or None
+    None if there is no frame to split at
+  
+  Notes
+  ---------------------------------------
+  The split frame is the first of a run of frames that are not part of 
+  any possible event, longer than the largest gap that is merged 
+  (ef.min_inter_frames_threshold), so that events on either side can 
+  never be merged. Its speed is not NaN, as the NaN values at the 
+  start of the data are included in the first event (see 
+  EventFinder.h__getStartStopIndices). Its length is not NaN either, so 
+  that the interpolation of the lengths after it does not depend on the 
+  lengths before it. Lastly the run is before the last non-NaN length, 
+  after which the interpolated lengths would change.
+  
+  """
+  ef, _, min_speeds, max_speeds, _ = \
+    h__getMotionEventFinder(midbody_speed, skeleton_lengths)
+  
+  num_frames = len(midbody_speed)
+  
+  is_possible_event = np.zeros(num_frames, dtype=bool)
+  for min_speed, max_speed in zip(min_speeds, max_speeds):
+    is_possible_event |= ef.get_possible_events_by_threshold(midbody_speed,
+                                   np.asarray(min_speed, dtype=float), 
+                                   np.asarray(max_speed, dtype=float))
+  
+  # The # of frames, starting at each frame, that are not part of any 
+  # possible event
+  frame_I = np.arange(num_frames)
+  next_event_I = np.minimum.accumulate(
+                   np.where(is_possible_event, frame_I, num_frames)[::-1])[::-1]
+  n_quiet_frames = next_event_I - frame_I
+  
+  n_split_frames = int(np.floor(ef.min_inter_frames_threshold)) + 1
+  
+  is_valid_length = ~np.isnan(skeleton_lengths)
+  if not np.any(is_valid_length):
+    return None
+  last_valid_length_I = num_frames - 1 - np.argmax(is_valid_length[::-1])
+  
+  n_usable_frames = min(n_final_frames, last_valid_length_I + 1)
+  
+  can_split = (n_quiet_frames >= n_split_frames) & \
+              (frame_I + n_split_frames <= n_usable_frames) & \
+              ~np.isnan(midbody_speed) & is_valid_length
+  
+  if not np.any(can_split):
+    return None
+  
+  return int(np.flatnonzero(can_split)[-1])
 
 
 
@@ -580,6 +688,51 @@ def h__getVelocityIndices(frames_per_sample, good_frames_mask):
   return keep_mask, left_I, right_I
 
 
+#Most recently used results of h__getVelocityIndices, last is newest
+#see h__getCachedVelocityIndices
+_velocity_indices_cache = collections.OrderedDict()
+
+def h__getCachedVelocityIndices(frames_per_sample, good_frames_mask):
+  """
+  Memoized version of h__getVelocityIndices
+  
+  All the velocities of a worm (from the 5 partitions in get_worm_velocity, 
+  as well as the path curvature) are computed from the same good frames, 
+  with only 2 different sample times. This keeps the most recent 
+  config.N_VELOCITY_INDICES_CACHED results so that the index search is 
+  only done once for each.
+  
+  Parameters
+  ---------------------------------------
+  frames_per_sample : int
+  good_frames_mask : [n_frames] bool
+  
+  Returns
+  ---------------------------------------
+  Same as h__getVelocityIndices. The arrays are shared between callers, so
+  they are read only.
+  
+  """
+  good_frames_mask = np.asarray(good_frames_mask, dtype=bool)
+  key = (frames_per_sample, len(good_frames_mask), 
+         np.packbits(good_frames_mask).tobytes())
+  
+  if key in _velocity_indices_cache:
+    #Move to the end, i.e. mark as most recently used
+    indices = _velocity_indices_cache.pop(key)
+  else:
+    indices = h__getVelocityIndices(frames_per_sample, good_frames_mask)
+    for x in indices:
+      x.flags.writeable = False
+    
+    while len(_velocity_indices_cache) >= config.N_VELOCITY_INDICES_CACHED:
+      _velocity_indices_cache.popitem(last=False)
+  
+  _velocity_indices_cache[key] = indices
+  
+  return indices
+
+
 def get_frames_per_sample(sample_time):
   """
   
@@ -626,7 +779,8 @@ def get_frames_per_sample(sample_time):
   return int(sampling_scale)
 
 
-def compute_velocity(sx, sy, avg_body_angle, sample_time, ventral_mode=0):
+def compute_velocity(sx, sy, avg_body_angle, sample_time, ventral_mode=0,
+                     centroid=None):
   """
     compute_velocity:
       The velocity is computed not using the nearest values but values
@@ -649,6 +803,10 @@ def compute_velocity(sx, sy, avg_body_angle, sample_time, ventral_mode=0):
                         0 = unknown
                         1 = clockwise
                         2 = anticlockwise
+                        
+        centroid: (optional) The frame-by-frame mean of sx and sy, shape 
+                  (2, n), e.g. from NormalizedWorm.get_partition_mean.
+                  If not given it is computed from sx and sy.
       OUTPUT:
         Two numpy arrays of shape (n), for 
         speed and direction, respectively.
@@ -665,9 +823,9 @@ def compute_velocity(sx, sy, avg_body_angle, sample_time, ventral_mode=0):
   # return with nothing.
   if(frames_per_sample > num_frames):
     # Create numpy arrays filled with NaNs
-    speed = np.empty((1, num_frames))
+    speed = np.empty((num_frames))
     speed.fill(np.NaN)
-    direction = np.empty((1, num_frames))
+    direction = np.empty((num_frames))
     direction.fill(np.NaN)
     return speed, direction
 
@@ -675,15 +833,18 @@ def compute_velocity(sx, sy, avg_body_angle, sample_time, ventral_mode=0):
   # calculate the velocity roughly centered on each sample, but with a
   # considerable width between frames that smooths the velocity.
   good_frames_mask = ~np.isnan(avg_body_angle)
-  keep_mask, left_I, right_I = h__getVelocityIndices(frames_per_sample, 
-                                                     good_frames_mask)
+  keep_mask, left_I, right_I = h__getCachedVelocityIndices(frames_per_sample, 
+                                                           good_frames_mask)
 
   # Compute speed
   # --------------------------------------------------------
 
   # Centroid of the current skeletal segment, frame-by-frame:
-  x_mean = np.mean(sx, 0)
-  y_mean = np.mean(sy, 0)
+  if centroid is None:
+    x_mean = np.mean(sx, 0)
+    y_mean = np.mean(sy, 0)
+  else:
+    x_mean, y_mean = centroid
   
   dX  = x_mean[right_I] - x_mean[left_I]
   dY  = y_mean[right_I] - y_mean[left_I]
@@ -793,7 +954,8 @@ def get_worm_velocity(nw, ventral_mode=0):
     speed, direction = compute_velocity(x, y, 
                                         avg_body_angle, 
                                         sample_time_values[partition_key], 
-                                        ventral_mode)
+                                        ventral_mode,
+                                        nw.get_partition_mean(partition_key))
     velocity[partition_key] = {'speed': speed, 'direction': direction}
   
   return velocity
@@ -99,9 +99,15 @@ class Duration:
     #    mean_width = mean(all_widths);    
     #end
 
+    #Only the frames with a skeleton can visit the arena
+    #------------------------------------------------------------------------
+    skeleton_mask = nw.frame_runs['skeleton'].mask
+    sx = sx[:,skeleton_mask]
+    sy = sy[:,skeleton_mask]
+
     #Return early if necessary
     #------------------------------------------------------------------------
-    if len(sx) == 0 or np.isnan(sx).all():
+    if sx.size == 0 or np.isnan(sx).all():
       raise Exception('This code is not yet translated')
       
       #ar = Arena(create_null = True)      
@@ -133,7 +139,7 @@ class Duration:
     scaled_zeroed_sx = (scaled_sx - x_scaled_min).astype(int)
     scaled_zeroed_sy = (scaled_sy - y_scaled_min).astype(int)     
     
-    arena_size  = [y_scaled_max - y_scaled_min + 1, x_scaled_max - x_scaled_min + 1]    
+    arena_size  = [int(y_scaled_max - y_scaled_min + 1), int(x_scaled_max - x_scaled_min + 1)]    
     ar = Arena(sx, sy, arena_size)
   
     #--------------------------------------------------------------------------
@@ -153,52 +159,80 @@ class Duration:
       isnan_mask: bool
         [49, n_frames]
         
+      Returns:
+      ----------------------------
+      arenas: list
+        [4], for each region a tuple of the (row,column) indices of the
+        visited locations [n_visited x 2] and the # of frames spent at
+        each location [n_visited]
+        
+      Notes:
+      ----------------------------
+      This used to fill a dense arena for each region, doing:
+      
+        temp_arena[cur_y,cur_x] += 1
+        
+      which only adds 1 to a location no matter how many points of the 
+      region are there in that frame. Instead, all regions are stacked 
+      into one set of locations, the repeated locations within each frame 
+      are removed, and the visited locations are counted with np.unique. 
+      The dense arenas, which can be large for worms that roam the plate, 
+      are never created.
       
       """
       
       #NOTE: All skeleton points have been rounded to integer values for
       #assignment to the matrix based on their values being treated as indices
+      
+      n_points    = len(s_points)
+      n_rows      = arena_size[0]
+      n_columns   = arena_size[1]
+      n_locations = n_rows*n_columns
+      
+      #Stack the skeleton indices of each region, with the location in 
+      #the arena offset by the region, i.e. each region gets its own arena
+      #------------------------------------------------------------------
+      all_skeleton_I = np.arange(sxs.shape[0])
+      region_I   = [all_skeleton_I[slice(*x)] for x in s_points]
+      skeleton_I = np.concatenate(region_I)
+      offsets    = np.repeat(np.arange(n_points)*n_locations, [len(x) for x in region_I])
+      
+      #Flip the rows to maintain consistency with Matlab
+      rows      = n_rows - 1 - sys[skeleton_I,:].astype(np.int64)
+      locations = rows*n_columns + sxs[skeleton_I,:] + offsets[:,None]
+      
+      #Invalid points get a location below all others and are dropped below
+      locations[isnan_mask[skeleton_I,:]] = -1
   
-  
-      #Filter out frames which have no valid values
+      #Count each location at most once per frame
       #----------------------------------------------------------
-      frames_run   = np.flatnonzero(np.any(~isnan_mask,axis=0))
-      n_frames_run = len(frames_run)
-       
-      #1 area for each set of skeleton indices
-      #-----------------------------------------
-      n_points = len(s_points)
-      arenas   = [None]*n_points
+      locations.sort(axis=0)
+      is_new_location = np.ones(locations.shape, dtype=bool)
+      is_new_location[1:,:] = locations[1:,:] != locations[:-1,:]
       
-      #Loop over the different regions of the body
-      #------------------------------------------------
-      for iPoint in range(n_points):
-             
-        temp_arena = np.zeros(arena_size)
-        s_indices  = s_points[iPoint]
-              
-        #For each frame, add +1 to the arena each time a chunk of the skeleton
-        #is located in that part
-        #----------------------------------------------------------------
-        for iFrame in range(n_frames_run):
-          cur_frame = frames_run[iFrame]
-          cur_x     = sxs[s_indices[0]:s_indices[1],cur_frame]
-          cur_y     = sys[s_indices[0]:s_indices[1],cur_frame]
-          temp_arena[cur_y,cur_x] += 1
+      locations = locations[is_new_location & (locations >= 0)]
       
-        arenas[iPoint] = temp_arena[::-1,:] #FLip axis to maintain
-        #consistency with Matlab
+      #Sorting the locations orders them by region, then row, then column,
+      #which is the order np.nonzero would give for each dense arena
+      visited, n_frames_visited = np.unique(locations, return_counts=True)
+      
+      region_bounds = np.searchsorted(visited, np.arange(n_points+1)*n_locations)
+      
+      arenas = [None]*n_points
+      for iPoint in range(n_points):
+        region_slice = slice(region_bounds[iPoint],region_bounds[iPoint+1])
+        cells = visited[region_slice] - iPoint*n_locations
+        
+        #transpose groups results by element rather than by dimension
+        indices = np.transpose(np.divmod(cells, n_columns))
+        arenas[iPoint] = (indices, n_frames_visited[region_slice])
       
       return arenas
     #----------------------------------------------------------------------------  
     
     temp_arenas   = h__populateArenas(arena_size, scaled_zeroed_sy, scaled_zeroed_sx, s_points, isnan_mask)  
 
-    #For looking at the data
-    #------------------------------------
-    #utils.imagesc(temp_arenas[0])
-
-    temp_duration = [DurationElement(x,fps) for x in temp_arenas]
+    temp_duration = [DurationElement.from_sparse_arena(x[0],x[1],fps) for x in temp_arenas]
 
     self.arena   = ar
     self.worm    = temp_duration[0]
@@ -224,6 +258,203 @@ class Duration:
     return temp
 
 
+class DurationAccumulator:
+  """
+  Builds a Duration from frames that are given a block at a time, e.g. 
+  while tracking, without keeping the skeletons of previous blocks.
+  
+  Duration scales the skeletons by the mean width of the worm over all of 
+  the frames, which changes as frames are added. Here the scale is 
+  instead fixed by the first frames that have widths (or given), so that 
+  the visited locations of each block can be counted once. The result is
+  the same as Duration for a worm with that mean width.
+  
+  Attributes
+  ---------------------------------------
+  scale : float
+  n_frames_visited : [n_regions x n_rows x n_columns]
+    The # of frames in which each location of each region was visited. 
+    The regions are the worm, head, midbody and tail, and the locations 
+    are in scaled coordinates, offset by row_offset and column_offset. 
+    This grows as the worm moves, doubling in size so that appending 
+    only touches the locations of the new frames.
+  row_offset : int
+  column_offset : int
+  
+  """
+  
+  def __init__(self, worm_partitions, fps, scale=None):
+    """
+    Parameters
+    ---------------------------------------
+    worm_partitions : dict
+      see NormalizedWorm.worm_partitions
+    fps : float
+    scale : float (optional)
+      The scale applied to the skeletons, see Duration
+    
+    """
+    self.s_points = [worm_partitions[x] for x in ('all', 'head', 'body', 'tail')]
+    self.fps      = fps
+    self.scale    = scale
+    
+    self.n_frames_visited = np.zeros((len(self.s_points), 0, 0), dtype=np.int64)
+    self.row_offset       = 0
+    self.column_offset    = 0
+    
+    # The extent of the unscaled skeletons, for the Arena
+    self.min_x = np.inf
+    self.min_y = np.inf
+    self.max_x = -np.inf
+    self.max_y = -np.inf
+  
+  def append(self, sx, sy, widths):
+    """
+    Add frames
+    
+    Parameters
+    ---------------------------------------
+    sx, sy : [49 x n_frames]
+    widths : [49 x n_frames]
+    
+    """
+    if not np.any(~np.isnan(sx)):
+      return
+    
+    if self.scale is None:
+      self.scale = 2.0**0.5/np.nanmean(widths)
+    
+    self.min_x = min(self.min_x, np.nanmin(sx))
+    self.min_y = min(self.min_y, np.nanmin(sy))
+    self.max_x = max(self.max_x, np.nanmax(sx))
+    self.max_y = max(self.max_y, np.nanmax(sy))
+    
+    with np.errstate(invalid='ignore'):
+      scaled_sx = np.round(sx*self.scale)
+      scaled_sy = np.round(sy*self.scale)
+    
+    # The (frame, region, row, column) of each valid point of each region
+    #----------------------------------------------------------------
+    n_points, n_frames = sx.shape
+    
+    all_skeleton_I = np.arange(n_points)
+    region_I   = [all_skeleton_I[slice(*x)] for x in self.s_points]
+    skeleton_I = np.concatenate(region_I)
+    regions    = np.repeat(np.arange(len(region_I)), [len(x) for x in region_I])
+    
+    is_valid = ~np.isnan(scaled_sx[skeleton_I,:])
+    point_I, frame_I = np.nonzero(is_valid)
+    
+    frame_locations = np.stack((frame_I, 
+                                regions[point_I],
+                                scaled_sy[skeleton_I,:][is_valid].astype(np.int64),
+                                scaled_sx[skeleton_I,:][is_valid].astype(np.int64)), 
+                               axis=1)
+    
+    # Count each location at most once per frame, then add the counts
+    # to those of the previous frames
+    #----------------------------------------------------------------
+    new_locations, new_n_frames_visited = \
+      np.unique(np.unique(frame_locations, axis=0)[:,1:], axis=0, 
+                return_counts=True)
+    
+    self.h__growArena(np.min(new_locations[:,1:], axis=0), 
+                      np.max(new_locations[:,1:], axis=0))
+    
+    self.n_frames_visited[new_locations[:,0], 
+                          new_locations[:,1] - self.row_offset,
+                          new_locations[:,2] - self.column_offset] += \
+      new_n_frames_visited
+  
+  def h__growArena(self, first_location, last_location):
+    """
+    Make n_frames_visited cover the rows and columns from first_location
+    to last_location, (row, column) each. A dimension that has to grow 
+    at least doubles in size.
+    """
+    _, n_rows, n_columns = self.n_frames_visited.shape
+    
+    if n_rows == 0:
+      self.row_offset, self.column_offset = first_location
+      first = np.array(first_location)
+      last  = np.array(last_location)
+    else:
+      old_first = np.array([self.row_offset, self.column_offset])
+      old_last  = old_first + [n_rows - 1, n_columns - 1]
+      old_size  = np.array([n_rows, n_columns])
+      
+      first = np.minimum(first_location, old_first)
+      last  = np.maximum(last_location, old_last)
+      if np.all(first == old_first) and np.all(last == old_last):
+        return
+      
+      first = np.where(first < old_first, 
+                       np.minimum(first, old_first - old_size), first)
+      last  = np.where(last > old_last, 
+                       np.maximum(last, old_last + old_size), last)
+    
+    n_frames_visited = np.zeros((len(self.s_points),) + tuple(last - first + 1),
+                                dtype=np.int64)
+    
+    row_I    = self.row_offset - first[0]
+    column_I = self.column_offset - first[1]
+    n_frames_visited[:, row_I:row_I + n_rows, column_I:column_I + n_columns] = \
+      self.n_frames_visited
+    
+    self.n_frames_visited = n_frames_visited
+    self.row_offset, self.column_offset = first
+  
+  def get_duration(self):
+    """
+    Returns
+    ---------------------------------------
+    Duration
+    
+    """
+    region_I, row_I, column_I = np.nonzero(self.n_frames_visited)
+    if len(region_I) == 0:
+      raise Exception('This code is not yet translated')
+    
+    n_frames_visited = self.n_frames_visited[region_I, row_I, column_I]
+    row_I    = row_I + self.row_offset
+    column_I = column_I + self.column_offset
+    
+    # The whole worm covers all points, so it gives the extent of the arena
+    is_worm = region_I == 0
+    y_scaled_min, y_scaled_max = np.min(row_I[is_worm]), np.max(row_I[is_worm])
+    x_scaled_min, x_scaled_max = np.min(column_I[is_worm]), np.max(column_I[is_worm])
+    
+    ar = Arena(None)
+    ar.height = int(y_scaled_max - y_scaled_min + 1)
+    ar.width  = int(x_scaled_max - x_scaled_min + 1)
+    ar.min_x  = self.min_x
+    ar.min_y  = self.min_y
+    ar.max_x  = self.max_x
+    ar.max_y  = self.max_y
+    
+    temp_duration = []
+    for iPoint in range(len(self.s_points)):
+      is_region = region_I == iPoint
+      
+      #Flip the rows to maintain consistency with Matlab, and sort by row
+      #then column as in Duration
+      rows    = y_scaled_max - row_I[is_region]
+      columns = column_I[is_region] - x_scaled_min
+      order   = np.lexsort((columns, rows))
+      
+      indices = np.stack((rows[order], columns[order]), axis=1)
+      temp_duration.append(DurationElement.from_sparse_arena(indices, 
+                              n_frames_visited[is_region][order], self.fps))
+    
+    temp = Duration(None)
+    temp.arena   = ar
+    temp.worm    = temp_duration[0]
+    temp.head    = temp_duration[1]
+    temp.midbody = temp_duration[2]
+    temp.tail    = temp_duration[3]
+    
+    return temp
+
 class DurationElement:
   
   def __init__(self,arena_coverage=None,fps=None):
@@ -237,6 +468,27 @@ class DurationElement:
 
   def __repr__(self):
     return utils.print_object(self)
+  
+  @staticmethod
+  def from_sparse_arena(indices,n_frames_visited,fps):
+    """
+    Create from the visited locations of an arena, rather than from the 
+    dense arena.
+    
+    Parameters
+    ---------------------------------------
+    indices : [n_visited x 2]
+      The (row,column) indices of the visited locations
+    n_frames_visited : [n_visited]
+      The # of frames spent at each location
+    fps : float
+      
+    """
+    temp = DurationElement(None)
+    temp.indices = indices
+    temp.times   = n_frames_visited/fps
+    
+    return temp
    
   @staticmethod 
   def from_disk(saved_duration_elem):
@@ -244,6 +496,8 @@ class DurationElement:
     temp.indices = saved_duration_elem['indices'].value
     temp.times   = saved_duration_elem['times'].value
     
+    return temp
+    
 class Arena:
    
   def __init__(self, sx=None, sy=None, arena_size=None, create_null=False):
@@ -283,10 +537,17 @@ class Arena:
     
     return temp
 
-def worm_path_curvature(x,y,fps,ventral_mode):
+def worm_path_curvature(x,y,fps,ventral_mode,centroid=None):
   
   """
   
+  Parameters
+  ---------------------------------------
+  x, y : [49 x n_frames]
+  fps : float
+  ventral_mode : int
+  centroid : [2 x n_frames] (optional)
+    The mean of x and y over all points, see compute_velocity
   
   """
   
@@ -305,10 +566,10 @@ def worm_path_curvature(x,y,fps,ventral_mode):
   #compute_velocity - inputs don't make sense ...
   #???? - sample_time??
   #???? - bodyI, BODY_DIFF, 
-  speed, motion_direction = feature_helpers.compute_velocity(x, y, avg_body_angles_d, config.BODY_DIFF, ventral_mode)
+  speed, motion_direction = feature_helpers.compute_velocity(x, y, avg_body_angles_d, config.BODY_DIFF, ventral_mode, centroid)
 
   frame_scale      = feature_helpers.get_frames_per_sample(config.BODY_DIFF)
-  half_frame_scale = (frame_scale - 1) / 2
+  half_frame_scale = (frame_scale - 1) // 2
 
   #Compute the angle differentials and distances.
   speed = abs(speed);
@@ -321,15 +582,20 @@ def worm_path_curvature(x,y,fps,ventral_mode):
   diff_motion    = np.empty(speed.shape)
   diff_motion[:] = np.NAN
   
-  right_max_I = len(diff_motion) - frame_scale
+  #With fewer than frame_scale frames there is no frame to compare to
+  n_frames    = len(diff_motion)
+  right_max_I = max(n_frames - frame_scale, 0)
   diff_motion[0:right_max_I] = motion_direction[frame_scale:] - motion_direction[0:right_max_I]
 
   with np.errstate(invalid='ignore'):
     diff_motion[diff_motion >= 180]  -= 360;
     diff_motion[diff_motion <= -180] += 360;
   
-  distance_I_base    = slice(half_frame_scale,-(frame_scale+1),1)
-  distance_I_shifted = slice(half_frame_scale + frame_scale,-1,1)  
+  #i.e. slice(half_frame_scale,-(frame_scale+1)) and 
+  #slice(half_frame_scale + frame_scale,-1), but empty for short videos
+  distance_end       = max(n_frames - (frame_scale+1), half_frame_scale)
+  distance_I_base    = slice(half_frame_scale,distance_end,1)
+  distance_I_shifted = slice(half_frame_scale + frame_scale,distance_end + frame_scale,1)  
     
   distance    = np.empty(speed.shape)
   distance[:] = np.NaN
@@ -9,15 +9,10 @@ from . import config
 import numpy as np
 import pdb
 import warnings
-import time
 import scipy.ndimage.filters as filters
 import collections
 
 
-#http://www.lfd.uci.edu/~gohlke/pythonlibs/#shapely
-from shapely.geometry.polygon import Polygon
-from shapely.geometry import Point
-
 class Bends(object):
 
   def __init__(self,nw):
@@ -57,7 +52,7 @@ class BendSection(object):
   def __repr__(self):
     return utils.print_object(self)
 
-def get_eccentricity_and_orientation(contour_x, contour_y):
+def get_eccentricity_and_orientation(contour_x, contour_y, method=None):
   """
     get_eccentricity   
    
@@ -88,10 +83,22 @@ def get_eccentricity_and_orientation(contour_x, contour_y):
                   the head (although no points are redundant)
       yOutline : [96 x num_frames]  The y coordinates of the contour "  "
       
+      method   : (optional) How the moments of the filled contour are
+                 computed. Defaults to ECCENTRICITY_METHOD from config.py.
+                 'grid'    - estimated by filling the contour with a grid
+                             of points, as in the Schafer Lab code
+                 'polygon' - exactly, from the contour vertices. Frames 
+                             whose contour crosses itself or encloses 
+                             almost no area use 'grid' instead.
+                 NOTE: 'polygon' takes the moments about the centroid of
+                 the enclosed area, 'grid' about the mean of the contour
+                 vertices, so the two differ slightly even for simple
+                 contours.
+      
       N_ECCENTRICITY (a constant from config.py):
                  (scalar) The # of points to place in the long dimension. More points
                  gives a more accurate estimate of the ellipse but increases
-                 the calculation time.
+                 the calculation time. Only used by the 'grid' method.
    
       Outputs: a namedtuple containing:
       =======================================================================
@@ -117,116 +124,422 @@ def get_eccentricity_and_orientation(contour_x, contour_y):
   +seg_worm / +feature_helpers / +posture / getEccentricity.m
   """
   
-  t_obj = time.time()
-  
-  N_GRID_POINTS = 50 #TODO: Get from config ...
-  
-  x_range_all       = np.ptp(contour_x,axis=0)
-  y_range_all       = np.ptp(contour_y,axis=0)
+  if method is None:
+    method = config.ECCENTRICITY_METHOD
   
   x_mc = contour_x - np.mean(contour_x,axis=0) #mc - mean centered
   y_mc = contour_y - np.mean(contour_y,axis=0)  
   
-  grid_aspect_ratio = x_range_all/y_range_all
+  if method == 'polygon':
+    uxx, uyy, uxy = h__getPolygonMoments(x_mc, y_mc)
+    
+    #The polygon formulas are only meaningful for simple contours
+    use_grid = h__getPolygonFallbackMask(x_mc, y_mc)
+    if np.any(use_grid):
+      uxx[use_grid], uyy[use_grid], uxy[use_grid] = \
+        h__getGridMoments(x_mc[:,use_grid], y_mc[:,use_grid], 
+                          config.N_ECCENTRICITY)
+  elif method == 'grid':
+    uxx, uyy, uxy = h__getGridMoments(x_mc, y_mc, config.N_ECCENTRICITY)
+  else:
+    raise Exception("Unrecognized eccentricity method: " + str(method))
+    
+  eccentricity, orientation = h__calculateSingleValues(uxx, uyy, uxy)
   
-  #run_mask = np.logical_not(np.isnan(grid_aspect_ratio))
+  return (eccentricity,orientation)
 
-  n_frames = len(x_range_all)
+def h__getPolygonMoments(x_mc, y_mc):
+  """
+  Compute the normalized second central moments of the region enclosed by 
+  each frame's contour directly from the contour vertices.
   
-  eccentricity    = np.empty(n_frames)
-  eccentricity[:] = np.NAN
-  orientation     = np.empty(n_frames)
-  orientation[:]  = np.NAN
- 
-  #h__getEccentricityAndOrientation
-  for iFrame in range(n_frames):
-    cur_aspect_ratio = grid_aspect_ratio[iFrame]
-
+  Parameters
+  ---------------------------------------
+  x_mc, y_mc : [96 x n_frames]
+    The mean centered contour coordinates
+  
+  Returns
+  ---------------------------------------
+  (uxx, uyy, uxy) : [n_frames] each, NaN for invalid frames
+  
+  Notes
+  ---------------------------------------
+  By Green's theorem the area integrals of 1, x, y, x^2, y^2 and xy over
+  a polygon reduce to sums over its edges, see e.g.
+  http://en.wikipedia.org/wiki/Second_moment_of_area#Any_polygon
+  
+  All sums carry the sign of the contour's direction, which cancels when
+  normalizing by the (signed) area. A contour that crosses itself, e.g. 
+  for a coiled worm, has its loops weighted by their winding direction
+  rather than by the even-odd rule used by the grid method, see 
+  h__getPolygonFallbackMask.
+  
+  The moments are taken about the centroid of the enclosed area, not 
+  about the mean of the contour vertices as in the grid method.
+  
+  """
+  #Edges go from point i to point i + 1, wrapping around to close the contour
+  x1 = x_mc
+  y1 = y_mc
+  x2 = np.roll(x_mc, -1, axis=0)
+  y2 = np.roll(y_mc, -1, axis=0)
+  
+  cross = x1*y2 - x2*y1
+  
+  with np.errstate(invalid='ignore', divide='ignore'):
+    area = np.sum(cross, axis=0)/2
     
-    #------------------------------------------------------
-    if not np.isnan(cur_aspect_ratio):
-      
-      cur_cx = x_mc[:,iFrame]
-      cur_cy = y_mc[:,iFrame]
-      poly = Polygon(zip(cur_cx,cur_cy))     
-      
-      if cur_aspect_ratio > 1:
-        #x size is larger so scale down the number of grid points in the y direction
-        n1 = N_GRID_POINTS
-        n2 = np.round(N_GRID_POINTS / cur_aspect_ratio)
-      else:
-        #y size is larger so scale down the number of grid points in the x direction        
-        n1 = np.round(N_GRID_POINTS * cur_aspect_ratio)
-        n2 = N_GRID_POINTS
+    centroid_x = np.sum((x1 + x2)*cross, axis=0)/(6*area)
+    centroid_y = np.sum((y1 + y2)*cross, axis=0)/(6*area)
     
+    #Second moments about the origin, normalized by the area
+    mxx = np.sum((x1*x1 + x1*x2 + x2*x2)*cross, axis=0)/(12*area)
+    myy = np.sum((y1*y1 + y1*y2 + y2*y2)*cross, axis=0)/(12*area)
+    mxy = np.sum((x1*y2 + 2*x1*y1 + 2*x2*y2 + x2*y1)*cross, axis=0)/(24*area)
+  
+  #Parallel axis theorem to move to the centroid
+  uxx = mxx - centroid_x**2
+  uyy = myy - centroid_y**2
+  uxy = mxy - centroid_x*centroid_y
+  
+  return uxx, uyy, uxy
+
+def h__getPolygonFallbackMask(x_mc, y_mc):
+  """
+  Find the frames whose moments can't be computed from the contour 
+  vertices, i.e. frames whose contour crosses itself or whose enclosed
+  area is near zero.
+  
+  Parameters
+  ---------------------------------------
+  x_mc, y_mc : [96 x n_frames]
+    The mean centered contour coordinates
+  
+  Returns
+  ---------------------------------------
+  use_grid : [n_frames]
+    True for the frames that should use the grid method. Invalid (NaN)
+    frames are False.
+  
+  """
+  n_points, n_frames = x_mc.shape
+  
+  use_grid = np.zeros(n_frames, dtype=bool)
+  
+  is_valid   = ~np.any(np.isnan(x_mc) | np.isnan(y_mc), axis=0)
+  run_frames = np.flatnonzero(is_valid)
+  
+  #Near zero area
+  #--------------------------------------------------------------------
+  x_v = x_mc[:,run_frames]
+  y_v = y_mc[:,run_frames]
+  area = np.abs(np.sum(x_v*np.roll(y_v,-1,axis=0) - 
+                       np.roll(x_v,-1,axis=0)*y_v, axis=0))/2
+  box_area = np.ptp(x_v,axis=0)*np.ptp(y_v,axis=0)
+  use_grid[run_frames] = area <= config.ECCENTRICITY_MIN_AREA_FRACTION*box_area
+  
+  #Self crossing
+  #--------------------------------------------------------------------
+  #Edge a goes from point a to point a + 1. Edges a and b cross if the ends
+  #of each edge lie on opposite sides of the other edge. Touching edges
+  #are not counted as crossing, and neither are neighboring edges, which
+  #always share a point.
+  a_I = np.arange(n_points)
+  n_apart = np.abs(a_I[:,None] - a_I[None,:])
+  can_cross = (n_apart >= 2) & (n_apart <= n_points - 2)
+  
+  block_size = config.N_ECCENTRICITY_FRAMES_PER_BLOCK
+  for block_start in range(0, len(run_frames), block_size):
+    cur_frames = run_frames[block_start:block_start + block_size]
+    x = x_mc[:,cur_frames]
+    y = y_mc[:,cur_frames]
+    dx = np.roll(x,-1,axis=0) - x
+    dy = np.roll(y,-1,axis=0) - y
     
-      wtf1 = np.linspace(np.min(x_mc[:,iFrame]), np.max(x_mc[:,iFrame]), num=n1);
-      wtf2 = np.linspace(np.min(y_mc[:,iFrame]), np.max(y_mc[:,iFrame]), num=n2);    
+    #side[a,b] - which side of edge a point b is on, i.e. the sign of 
+    #the cross product of the edge with the vector to the point
+    side = np.sign(dx[:,None]*y[None,:] - dy[:,None]*x[None,:] - 
+                   (dx*y - dy*x)[:,None])
+    straddles = side*np.roll(side,-1,axis=1) < 0
+    crosses = straddles & straddles.transpose(1,0,2) & can_cross[:,:,None]
     
-      m,n = np.meshgrid( wtf1 , wtf2 );
-
+    use_grid[cur_frames] |= np.any(crosses, axis=(0,1))
+  
+  return use_grid
 
+def h__getGridMoments(x_mc, y_mc, N_GRID_POINTS):
+  """
+  Estimate the normalized second central moments of the region enclosed
+  by each frame's contour by filling it with a grid of evenly spaced points.
+  
+  Parameters
+  ---------------------------------------
+  x_mc, y_mc : [96 x n_frames]
+    The mean centered contour coordinates
+  N_GRID_POINTS : int
+    The # of grid points to place in the long dimension
+  
+  Returns
+  ---------------------------------------
+  (uxx, uyy, uxy) : [n_frames] each, NaN for invalid frames
+  
+  """
+  x_range_all = np.ptp(x_mc,axis=0)
+  y_range_all = np.ptp(y_mc,axis=0)
+  
+  with np.errstate(invalid='ignore', divide='ignore'):
+    grid_aspect_ratio = x_range_all/y_range_all
+  
+  n_frames = len(x_range_all)
+  
+  uxx = np.empty(n_frames)
+  uxx[:] = np.NaN
+  uyy = uxx.copy()
+  uxy = uxx.copy()
+  
+  #Frames are processed in blocks so that the grid for every frame in the
+  #block can be filled at once without the memory use growing with the
+  #length of the video
+  run_frames = np.flatnonzero(~np.isnan(grid_aspect_ratio))
+  block_size = config.N_ECCENTRICITY_FRAMES_PER_BLOCK
+ 
+  for block_start in range(0, len(run_frames), block_size):
+    cur_frames = run_frames[block_start:block_start + block_size]
     
-      n_points = m.size
-      m_lin    = m.reshape(n_points)
-      n_lin    = n.reshape(n_points)  
-      in_worm  = np.zeros(n_points,dtype=np.bool)
-      for i in range(n_points):
-        p = Point(m_lin[i],n_lin[i])
-#        try:
-        in_worm[i] = poly.contains(p)
-#        except ValueError:
-#          import pdb
-#          pdb.set_trace()
-        
-      
-        x = m_lin[in_worm]
-        y = n_lin[in_worm]
-      
-      """
-        TODO: Finish this
-        plot(xOutline_mc(:,iFrame),yOutline_mc(:,iFrame),'g-o')
-        hold on
-        scatter(x,y,'r')
-        hold off
-        axis equal
-        title(sprintf('%d',iFrame))
-        pause
-      """
-    
+    grid_x, grid_y, in_worm = h__getGridPointsInWorm(x_mc[:,cur_frames],
+                                                     y_mc[:,cur_frames],
+                                                     grid_aspect_ratio[cur_frames],
+                                                     N_GRID_POINTS)
     
-      #First eccentricity value should be: 0.9743
+    #in_worm is [frames x rows (y) x columns (x)], so summing over the rows
+    #gives the # of points in each column and vice versa
+    with np.errstate(invalid='ignore', divide='ignore'):
+      N = np.sum(in_worm, axis=(1,2))
+      uxx[cur_frames] = np.sum(np.sum(in_worm, axis=1)*grid_x**2, axis=1)/N
+      uyy[cur_frames] = np.sum(np.sum(in_worm, axis=2)*grid_y**2, axis=1)/N
+      uxy[cur_frames] = np.einsum('frc,fr,fc->f', in_worm, grid_y, grid_x)/N
+  
+  return uxx, uyy, uxy
 
-      #h__calculateSingleValues
-      N = float(len(x))
-      # Calculate normalized second central moments for the region.
-      uxx = np.sum(x*x)/N
-      uyy = np.sum(y*y)/N
-      uxy = np.sum(x*y)/N
+def h__getGridPointsInWorm(x_mc, y_mc, grid_aspect_ratio, N_GRID_POINTS):
+  """
+  Fill the contour of each frame with a grid of evenly spaced points and
+  determine which of the grid points lie within the worm.
+  
+  Parameters
+  ---------------------------------------
+  x_mc, y_mc : [96 x n_frames] 
+    The mean centered contour coordinates of the frames to process.
+    All frames must be valid (i.e. not NaN)
+  grid_aspect_ratio : [n_frames]
+    x range / y range of each contour
+  N_GRID_POINTS : int
+    The # of grid points to place in the long dimension
+  
+  Returns
+  ---------------------------------------
+  grid_x : [n_frames x N_GRID_POINTS]
+    The x coordinates of the grid columns, padded with 0
+  grid_y : [n_frames x N_GRID_POINTS]
+    The y coordinates of the grid rows, padded with 0
+  in_worm : [n_frames x N_GRID_POINTS (rows, y) x N_GRID_POINTS (columns, x)]
+    True for grid points inside the contour. Padding is always False.
+  
+  Notes
+  ---------------------------------------
+  The Point-in-Polygon test is done with the crossing number (even-odd)
+  rule, http://en.wikipedia.org/wiki/Point_in_polygon
+  
+  All the points of a grid row share the same y value, so the x locations
+  at which the contour crosses the row only need to be computed once per
+  row. Since the grid columns are evenly spaced, each crossing can then be
+  converted to the # of columns to its left, and the # of crossings to the 
+  right of any column follows from a cumulative sum over the columns. 
   
-      # Calculate major axis length, minor axis length, and eccentricity.
-      common               = np.sqrt((uxx - uyy)**2 + 4*(uxy**2))
-      majorAxisLength      = 2*np.sqrt(2)*np.sqrt(uxx + uyy + common)
-      minorAxisLength      = 2*np.sqrt(2)*np.sqrt(uxx + uyy - common)
-      eccentricity[iFrame] = 2*np.sqrt((majorAxisLength/2)**2 - (minorAxisLength/2)**2) / majorAxisLength
+  """
+  n_frames = x_mc.shape[1]
+  
+  #Number of grid points in the x (n_x) and y (n_y) directions
+  #--------------------------------------------------------------
+  n_x = np.empty(n_frames)
+  n_y = np.empty(n_frames)
+  
+  #x size is larger so scale down the number of grid points in the y direction
+  x_larger      = grid_aspect_ratio > 1
+  n_x[x_larger] = N_GRID_POINTS
+  n_y[x_larger] = np.round(N_GRID_POINTS / grid_aspect_ratio[x_larger])
+  #y size is larger so scale down the number of grid points in the x direction
+  n_x[~x_larger] = np.round(N_GRID_POINTS * grid_aspect_ratio[~x_larger])
+  n_y[~x_larger] = N_GRID_POINTS
+  
+  grid_x, grid_x_step, x_valid = h__linspaceRows(np.min(x_mc,axis=0), 
+                                                 np.max(x_mc,axis=0), 
+                                                 n_x, N_GRID_POINTS)
+  grid_y, _, y_valid           = h__linspaceRows(np.min(y_mc,axis=0), 
+                                                 np.max(y_mc,axis=0), 
+                                                 n_y, N_GRID_POINTS)
+  
+  #Crossings of each contour edge with each grid row
+  #--------------------------------------------------------------
+  #Edges go from point i to point i + 1, wrapping around to close the contour
+  #Shape of each is [n_frames x 1 x 96]
+  x1 = np.transpose(x_mc)[:,None,:]
+  y1 = np.transpose(y_mc)[:,None,:]
+  x2 = np.roll(x1, -1, axis=2)
+  y2 = np.roll(y1, -1, axis=2)
+  
+  #Padded rows are NaN so they never register a crossing
+  row_y = np.where(y_valid, grid_y, np.NaN)[:,:,None]
+  
+  #[n_frames x n_rows x 96]
+  with np.errstate(invalid='ignore', divide='ignore'):
+    crosses_row = (y1 > row_y) != (y2 > row_y)
+    x_crossing  = (x2 - x1)*(row_y - y1)/(y2 - y1) + x1
+  
+    #The # of grid columns to the left of each crossing, i.e. the # of 
+    #grid points in the row for which this crossing is to their right
+    x0         = grid_x[:,0][:,None,None]
+    x_step     = grid_x_step[:,None,None]
+    n_x_3d     = n_x[:,None,None]
+    n_cols_left = np.where(n_x_3d > 1,
+                           np.ceil((x_crossing - x0)/x_step),
+                           x_crossing > x0)
+    n_cols_left = np.clip(n_cols_left, 0, n_x_3d)[crosses_row]
+  
+  #Histogram the crossings by frame, row and # of columns to their left
+  frame_I, row_I, _ = crosses_row.nonzero()
+  n_bins   = N_GRID_POINTS + 1
+  bin_I    = (frame_I*N_GRID_POINTS + row_I)*n_bins + n_cols_left.astype(int)
+  counts   = np.bincount(bin_I, minlength=n_frames*N_GRID_POINTS*n_bins)
+  counts   = counts.reshape((n_frames, N_GRID_POINTS, n_bins))
+  
+  #A point is inside if there are an odd # of crossings to its right
+  n_right  = np.sum(counts, axis=2)[:,:,None] - np.cumsum(counts, axis=2)
+  in_worm  = (n_right[:,:,:-1] % 2) == 1
+  in_worm &= y_valid[:,:,None] & x_valid[:,None,:]
+  
+  return grid_x, grid_y, in_worm
+
+def h__linspaceRows(start, stop, num, max_num):
+  """
+  np.linspace for many rows at once, where each row can have a different
+  # of points. 
+  
+  Parameters
+  ---------------------------------------
+  start, stop, num : [n_rows]
+  max_num : int
+    The maximum value in num
+  
+  Returns
+  ---------------------------------------
+  values : [n_rows x max_num]
+    Row i contains np.linspace(start[i], stop[i], num[i]), padded with 0
+  step : [n_rows]
+    The spacing of each row, NaN for rows with fewer than 2 points
+  is_valid : [n_rows x max_num]
+    False for the padded values
   
-      # Calculate orientation.
-      if (uyy > uxx):
-        num = uyy - uxx + np.sqrt((uyy - uxx)**2 + 4*uxy**2)
-        den = 2*uxy
-      else:
-        num = 2*uxy
-        den = uxx - uyy + np.sqrt((uxx - uyy)**2 + 4*uxy**2)
+  """
+  column_I = np.arange(max_num)[None,:]
+  num      = num[:,None]
+  
+  with np.errstate(invalid='ignore', divide='ignore'):
+    step = np.where(num > 1, (stop - start)[:,None]/(num - 1), np.NaN)
+    values = np.where(num > 1, column_I*step + start[:,None], start[:,None])
   
-      orientation[iFrame] = (180/np.pi) * np.arctan(num/den)
+  #Like linspace we make sure the endpoint is exact
+  values   = np.where(column_I == num - 1, stop[:,None], values)
+  is_valid = column_I < num
+  values[~is_valid] = 0
+  
+  return values, step[:,0], is_valid
 
-    #[eccentricity(iFrame),orientation(iFrame)] = h__calculateSingleValues(x,y);  
+def h__interpColumns(x, xp, fp):
+  """
+  np.interp for many columns at once, i.e. column i of the output is
+  np.interp(x[:,i], xp[:,i], fp[:,i])
+  
+  Parameters
+  ---------------------------------------
+  x : [n_x x n_columns]
+  xp : [n_xp x n_columns]
+    Must be increasing within each column
+  fp : [n_xp x n_columns]
+  
+  Returns
+  ---------------------------------------
+  [n_x x n_columns]
+  
+  Notes
+  ---------------------------------------
+  The columns are shifted so that they can be placed end to end into one
+  increasing array, which allows the interval containing every x value 
+  to be found with a single call to np.searchsorted.
   
+  """
+  n_xp, n_columns = xp.shape
   
-  elapsed_time = time.time() - t_obj
-  print('Elapsed time in seconds for eccentricity: %d' % elapsed_time)
+  if n_columns == 0:
+    return np.zeros(x.shape)
   
-  return (eccentricity,orientation)
+  #Shift each column so it starts 1 past the end of the previous column
+  x_start = xp[0,:]
+  x_range = xp[-1,:] - x_start
+  offset  = np.concatenate(([0], np.cumsum(x_range + 1)[:-1])) - x_start
+  
+  xp_all = (xp + offset).flatten('F')
+  x_all  = np.clip(x, x_start, xp[-1,:]) + offset
+  
+  #Index of the first point of the interval containing each x
+  column_start_I = np.arange(n_columns)*n_xp
+  left_I = np.searchsorted(xp_all, x_all.flatten('F'), 'right').reshape(x.shape, order='F') - 1
+  left_I = np.clip(left_I, column_start_I, column_start_I + n_xp - 2)
+  
+  xp_flat = xp.flatten('F')
+  fp_flat = fp.flatten('F')
+  
+  x0 = xp_flat[left_I]
+  f0 = fp_flat[left_I]
+  with np.errstate(invalid='ignore', divide='ignore'):
+    slope = (fp_flat[left_I + 1] - f0)/(xp_flat[left_I + 1] - x0)
+  
+  return slope*(x - x0) + f0
+
+def h__calculateSingleValues(uxx, uyy, uxy):
+  """
+  Compute the eccentricity and orientation of the equivalent ellipse from
+  the normalized second central moments of each frame.
+  
+  Parameters
+  ---------------------------------------
+  uxx, uyy, uxy : [n_frames]
+  
+  Returns
+  ---------------------------------------
+  (eccentricity, orientation) : [n_frames] each
+  
+  """
+  with np.errstate(invalid='ignore', divide='ignore'):
+    # Calculate major axis length, minor axis length, and eccentricity.
+    common            = np.sqrt((uxx - uyy)**2 + 4*(uxy**2))
+    major_axis_length = 2*np.sqrt(2)*np.sqrt(uxx + uyy + common)
+    minor_axis_length = 2*np.sqrt(2)*np.sqrt(uxx + uyy - common)
+    eccentricity      = 2*np.sqrt((major_axis_length/2)**2 - 
+                                  (minor_axis_length/2)**2) / major_axis_length
+  
+    # Calculate orientation.
+    y_larger = uyy > uxx
+    num = np.where(y_larger, 
+                   uyy - uxx + np.sqrt((uyy - uxx)**2 + 4*uxy**2),
+                   2*uxy)
+    den = np.where(y_larger,
+                   2*uxy,
+                   uxx - uyy + np.sqrt((uxx - uyy)**2 + 4*uxy**2))
+  
+    orientation = (180/np.pi) * np.arctan(num/den)
+  
+  return (eccentricity, orientation)
 
 def get_amplitude_and_wavelength(theta_d, sx, sy, worm_lengths):
 
@@ -234,14 +547,11 @@ def get_amplitude_and_wavelength(theta_d, sx, sy, worm_lengths):
   
   
   N_POINTS_FFT   = 512
-  HALF_N_FFT     = N_POINTS_FFT/2
+  HALF_N_FFT     = N_POINTS_FFT//2
   MIN_DIST_PEAKS = 5  
   WAVELENGTH_PCT_MAX_CUTOFF = 0.5 #TODO: Describe
   WAVELENGTH_PCT_CUTOFF     = 2
   
-  #TODO: Write in Python
-  #assert(size(sx,1) <= N_POINTS_FFT,'# of points used in the FFT must be more than the # of points in the skeleton')  
-  
   theta_r = theta_d*(np.pi/180);  
   
   #Unrotate worm
@@ -304,86 +614,101 @@ def get_amplitude_and_wavelength(theta_d, sx, sy, worm_lengths):
 
   frames_to_calculate = (np.logical_not(bad_worm_orientation)).nonzero()[0]
 
-  for cur_frame in frames_to_calculate:
-    
-    #Create an evenly sampled x-axis, note that ds varies
-    x1 = wwx[0,cur_frame]
-    x2 = wwx[-1,cur_frame]
-    if x1 > x2:
-      iwwx = utils.colon(x1,-ds[cur_frame],x2)
-      iwwy = np.interp(iwwx,wwx[::-1,cur_frame],wwy[::-1,cur_frame])
-      iwwy = iwwy[::-1]
-    else:
-      iwwx = utils.colon(x1,ds[cur_frame],x2)
-      iwwy = np.interp(iwwx,wwx[:,cur_frame],wwy[:,cur_frame])
-      iwwy = iwwy[::-1]
-    
-    temp = np.fft.fft(iwwy,N_POINTS_FFT)
-       
-    if config.MIMIC_OLD_BEHAVIOUR:
-      iY = temp[0:HALF_N_FFT]
-      iY = iY*np.conjugate(iY)/N_POINTS_FFT
-    else:
-      iY = np.abs(temp[0:HALF_N_FFT])
-      
-    #Find peaks that are greater than the cutoff  
-    peaks, indx = utils.max_peaks_dist(iY, MIN_DIST_PEAKS,True,WAVELENGTH_PCT_MAX_CUTOFF*np.amax(iY))  
-      
+  #Create an evenly sampled x-axis for every frame, note that ds varies
+  #--------------------------------------------------------------------------
+  #The resampled worms are placed in a [frames x N_POINTS_FFT] matrix, 
+  #padded with zeros, so that the FFTs of all frames are done at once.
+  #
+  #NOTE: Like utils.colon the samples always start at the smaller of the 
+  #two end points, x1 or x2. The old code then reversed the data in 
+  #some cases, but this doesn't change the magnitude of the FFT so we don't.
+  cur_wwx = wwx[:,frames_to_calculate]
+  cur_wwy = wwy[:,frames_to_calculate]
+  cur_ds  = ds[frames_to_calculate]
+  
+  #np.interp requires increasing x values
+  is_decreasing = cur_wwx[0,:] > cur_wwx[-1,:]
+  cur_wwx = np.where(is_decreasing, cur_wwx[::-1,:], cur_wwx)
+  cur_wwy = np.where(is_decreasing, cur_wwy[::-1,:], cur_wwy)
+  
+  x_start = cur_wwx[0,:]
+  x_range = cur_wwx[-1,:] - x_start
+  
+  #The same # of samples as utils.colon(x_start,cur_ds,x_start + x_range)
+  n_samples = (x_range + 2*np.spacing(x_range))//cur_ds + 1
+  max_n_samples = int(np.max(n_samples)) if n_samples.size > 0 else 0
 
-    #pdb.set_trace() # DEBUG
-    #This is what the supplemental says, not what was done in the previous
-    #code. I'm not sure what was done for the actual paper, but I would
-    #guess they used power.
-    #
-    #This gets used when determining the secondary wavelength, as it must
-    #be greater than half the maximum to be considered a secondary
-    #wavelength.
+  if max_n_samples > N_POINTS_FFT:
+    raise Exception("# of points used in the FFT must be more than the # of points in the resampled skeleton")
+  
+  iwwx, _, is_sample = h__linspaceRows(x_start, 
+                                       x_start + cur_ds*(n_samples - 1), 
+                                       n_samples, max_n_samples)
+                                       
+  iwwy = np.zeros((len(frames_to_calculate), N_POINTS_FFT))
+  iwwy[:,:max_n_samples] = h__interpColumns(iwwx.T, cur_wwx, cur_wwy).T
+  iwwy[:,:max_n_samples][~is_sample] = 0
+  
+  temp = np.fft.rfft(iwwy, N_POINTS_FFT, axis=1)
+       
+  if config.MIMIC_OLD_BEHAVIOUR:
+    iY = np.abs(temp[:,0:HALF_N_FFT])**2/N_POINTS_FFT
+  else:
+    iY = np.abs(temp[:,0:HALF_N_FFT])
     
-    #NOTE: True Amplitude = 2*abs(fft)/(length_real_data i.e. 48 or 49, not 512)
-    #
-    #i.e. for a sinusoid of a given amplitude, the above formula would give
-    #you the amplitude of the sinusoid
+  #Find peaks that are greater than the cutoff  
+  #--------------------------------------------------------------------------
+  is_peak = utils.max_peaks_dist_2d(iY, MIN_DIST_PEAKS, True, 
+                                    WAVELENGTH_PCT_MAX_CUTOFF*np.amax(iY, axis=1))
+
+  #This is what the supplemental says, not what was done in the previous
+  #code. I'm not sure what was done for the actual paper, but I would
+  #guess they used power.
+  #
+  #This gets used when determining the secondary wavelength, as it must
+  #be greater than half the maximum to be considered a secondary
+  #wavelength.
   
-    #We sort the peaks so that the largest is at the first index and will
-    #be primary, this was not done in the previous version of the code
-    I = np.argsort(-1*peaks)
-    indx = indx[I]
+  #NOTE: True Amplitude = 2*abs(fft)/(length_real_data i.e. 48 or 49, not 512)
+  #
+  #i.e. for a sinusoid of a given amplitude, the above formula would give
+  #you the amplitude of the sinusoid
 
-    frequency_values = (indx - 1)/N_POINTS_FFT*spatial_sampling_frequency[cur_frame]
-    
-    all_wavelengths = 1/frequency_values
-    
-    p_temp = all_wavelengths[0]
-    
-    if indx.size > 1:
-      s_temp = all_wavelengths[1]
-    else:
-      s_temp = np.NaN
-      
-    worm_wavelength_max = WAVELENGTH_PCT_CUTOFF*worm_lengths[cur_frame]
-    
-    #Cap wavelengths ...
-    if p_temp > worm_wavelength_max:
-      p_temp = worm_wavelength_max
+  #We sort the peaks so that the largest is at the first index and will
+  #be primary, this was not done in the previous version of the code
+  #
+  #Non-peaks are given a value of -Inf so that they sort last
+  peak_values = np.where(is_peak, iY, -np.inf)
+  sorted_I    = np.argsort(-1*peak_values, axis=1, kind='mergesort')
+  n_peaks     = np.sum(is_peak, axis=1)
+
+  with np.errstate(divide='ignore', invalid='ignore'):
+    frequency_values = (sorted_I[:,0:2] - 1)/N_POINTS_FFT*spatial_sampling_frequency[frames_to_calculate][:,None]
+    all_wavelengths  = 1/frequency_values
+  
+  p_temp = all_wavelengths[:,0]
+  s_temp = np.where(n_peaks > 1, all_wavelengths[:,1], np.NaN)
       
+  worm_wavelength_max = WAVELENGTH_PCT_CUTOFF*worm_lengths[frames_to_calculate]
     
-    #??? Do we really want to keep this as well if p_temp == worm_2x?
-    #i.e., should the secondary wavelength be valid if the primary is also
-    #limited in this way ?????
-    if s_temp > worm_wavelength_max:
-        s_temp = worm_wavelength_max
+  #Cap wavelengths ...
+  #??? Do we really want to keep this as well if p_temp == worm_2x?
+  #i.e., should the secondary wavelength be valid if the primary is also
+  #limited in this way ?????
+  with np.errstate(invalid='ignore'):
+    p_temp = np.where(p_temp > worm_wavelength_max, worm_wavelength_max, p_temp)
+    s_temp = np.where(s_temp > worm_wavelength_max, worm_wavelength_max, s_temp)
 
-    #TODO: Not yet translated    
-    """
-    if d_opts.mimic_old_behavior
-        mask = s_wavelength > p_wavelength;
-        [p_wavelength(mask),s_wavelength(mask)] = deal(s_wavelength(mask),p_wavelength(mask));
-    end
-    """    
-    
+  #TODO: Not yet translated    
+  """
+  if d_opts.mimic_old_behavior
+      mask = s_wavelength > p_wavelength;
+      [p_wavelength(mask),s_wavelength(mask)] = deal(s_wavelength(mask),p_wavelength(mask));
+  end
+  """    
     
-    p_wavelength[cur_frame] = p_temp
-    s_wavelength[cur_frame] = s_temp
+  p_wavelength[frames_to_calculate] = p_temp
+  s_wavelength[frames_to_calculate] = s_temp
             
   amp_wave_track = \
     collections.namedtuple('amp_wave_track', 
@@ -409,7 +734,22 @@ Old Vs New Code:
 
 """
 
-def get_worm_kinks(bend_angles):
+def get_worm_kinks(bend_angles, frame_mask=None):
+  """
+  Parameters
+  ---------------------------------------
+  bend_angles : [n_angles x n_frames]
+  frame_mask : [n_frames] bool, optional
+    The frames to compute kinks for, e.g. 
+    NormalizedWorm.frame_runs['skeleton'].mask. Frames outside the mask
+    are NaN. If not given all frames are used, which gives 0 kinks 
+    rather than NaN for frames without any angles.
+  
+  Returns
+  ---------------------------------------
+  n_kinks_all : [n_frames]
+  
+  """
   #https://github.com/JimHokanson/SegwormMatlabClasses/blob/master/%2Bseg_worm/%2Bfeatures/%40posture/getWormKinks.m
 
 
@@ -432,66 +772,104 @@ def get_worm_kinks(bend_angles):
   n_kinks_all    = np.zeros(n_frames,dtype=float)
   n_kinks_all[:] = np.NaN
 
-  #(np.any(np.logical_or(mask_pos,mask_neg),axis=0)).nonzero()[0]
-
-  for iFrame in (np.any(bend_angles,axis=0)).nonzero()[0]:
-    smoothed_bend_angles = filters.convolve1d(bend_angles[:,iFrame],gauss_filter,cval=0,mode='constant')
+  #Frames with all zero angles are left as NaN. All frames are smoothed at
+  #once, along the angle axis.
+  has_angles = np.any(bend_angles,axis=0)
+  if frame_mask is not None:
+    has_angles &= frame_mask
+  frame_I = has_angles.nonzero()[0]
   
-    #This code is nearly identical in getForaging
-    #-------------------------------------------------------
-    n_frames = smoothed_bend_angles.shape[0]
-
-    with np.errstate(invalid='ignore'):
-      dataSign = np.sign(smoothed_bend_angles)
-    
-    if np.any(np.equal(dataSign,0)):
-        #I don't expect that we'll ever actually reach 0
-        #The code for zero was a bit weird, it keeps counting if no sign
-        #change i.e. + + + 0 + + + => all +
-        #
-        #but if counts for both if sign change
-        # + + 0 - - - => 3 +s and 4 -s    
-        raise Exception("Unhandled code case")
-    
-    sign_change_I = (np.not_equal(dataSign[1:],dataSign[0:-1])).nonzero()[0]
-
-    end_I   = np.concatenate((sign_change_I,n_frames*np.ones(1,dtype=np.result_type(sign_change_I))))
-    
-    wtf1    = np.zeros(1,dtype=np.result_type(sign_change_I))
-    wtf2    = sign_change_I+1
-    start_I = np.concatenate((wtf1,wtf2)) #+2? due to inclusion rules???
-
-    #All NaN values are considered sign changes, remove these ...
-    keep_mask = np.logical_not(np.isnan(smoothed_bend_angles[start_I]))
-
-    start_I = start_I[keep_mask]
-    end_I   = end_I[keep_mask]
-    
-    #The old code had a provision for having NaN values in the middle
-    #of the worm. I have not translated that feature to the newer code. I
-    #don't think it will ever happen though for a valid frame, only on the
-    #edges should you have NaN values.
-    if start_I.size != 0 and np.any(np.isnan(smoothed_bend_angles[start_I[0]:end_I[-1]])):
-       raise Exception("Unhandled code case")
-       
-    #-------------------------------------------------------
-    #End of identical code ...
-    
-    lengths = end_I - start_I + 1
-
-    #Adjust lengths for first and last:
-    #Basically we allow NaN values to count towards the length for the
-    #first and last stretches
-    if lengths.size != 0:
-       if start_I[0] != 0: #Due to leading NaNs
-          lengths[0] = end_I[0] + 1
-       if end_I[-1] != n_frames: #Due to trailing NaNs
-          lengths[-1] = n_frames - start_I[-1]
-    
-    n_kinks_all[iFrame] = np.sum(lengths >= length_threshold)
+  smoothed_bend_angles = filters.convolve1d(bend_angles[:,frame_I],gauss_filter,
+                                            axis=0,cval=0,mode='constant')
+  
+  n_kinks_all[frame_I] = h__countBendSegments(smoothed_bend_angles, length_threshold)
     
   return n_kinks_all
 
+def h__countBendSegments(smoothed_bend_angles, length_threshold):
+  """
+  Count, for each frame, the runs of bend angles of the same sign that are
+  at least length_threshold long.
+  
+  Parameters
+  ---------------------------------------
+  smoothed_bend_angles : [n_angles x n_frames]
+  length_threshold : scalar
+  
+  Returns
+  ---------------------------------------
+  n_kinks : [n_frames]
+  
+  Notes
+  ---------------------------------------
+  This reproduces the length rules of the original per frame code:
+  
+  - the last run of the worm (the one ending at the tail) is 1 longer 
+    than it really is
+  - NaN values on the edges count towards the length of the first and
+    last runs. When there are trailing NaNs the last run is n_angles - start
+    long, which takes precedence if there is only 1 run.
+  
+  """
+  n_angles, n_frames = smoothed_bend_angles.shape
+  
+  #This code is nearly identical in getForaging
+  #-------------------------------------------------------
+  with np.errstate(invalid='ignore'):
+    dataSign = np.sign(smoothed_bend_angles)
+  
+  if np.any(np.equal(dataSign,0)):
+    #I don't expect that we'll ever actually reach 0
+    #The code for zero was a bit weird, it keeps counting if no sign
+    #change i.e. + + + 0 + + + => all +
+    #
+    #but if counts for both if sign change
+    # + + 0 - - - => 3 +s and 4 -s    
+    raise Exception("Unhandled code case")
+  
+  is_nan = np.isnan(smoothed_bend_angles)
+  
+  #The old code had a provision for having NaN values in the middle
+  #of the worm. I have not translated that feature to the newer code. I
+  #don't think it will ever happen though for a valid frame, only on the
+  #edges should you have NaN values.
+  is_valid  = ~is_nan
+  has_valid = np.any(is_valid,axis=0)
+  first_I   = np.argmax(is_valid,axis=0)
+  last_I    = n_angles - 1 - np.argmax(is_valid[::-1],axis=0)
+  if np.any(has_valid & (last_I - first_I + 1 != np.sum(is_valid,axis=0))):
+    raise Exception("Unhandled code case")
+  
+  #All NaN values are considered sign changes, so we only keep runs of
+  #valid values
+  is_change = np.ones((n_angles+1,n_frames),dtype=bool)
+  is_change[1:-1] = np.not_equal(dataSign[1:],dataSign[:-1])
+  
+  #nonzero() on the transpose sorts by frame, then by angle, so that the
+  #starts and ends of each run line up
+  start_frame_I, start_I = (is_valid & is_change[:-1]).T.nonzero()
+  end_I = (is_valid & is_change[1:]).T.nonzero()[1]
+  #-------------------------------------------------------
+  #End of identical code ...
+  
+  is_at_tail = end_I == n_angles - 1
+  lengths    = end_I - start_I + 1 + is_at_tail
+  
+  #Adjust lengths for first and last:
+  #Basically we allow NaN values to count towards the length for the
+  #first and last stretches
+  first_I = first_I[start_frame_I]
+  last_I  = last_I[start_frame_I]
+  
+  fix_first = (start_I == first_I) & (first_I != 0) #Due to leading NaNs
+  lengths[fix_first] = end_I[fix_first] + 1 + is_at_tail[fix_first]
+  
+  fix_last = (end_I == last_I) & ~is_at_tail #Due to trailing NaNs
+  lengths[fix_last] = n_angles - start_I[fix_last]
+  
+  return np.bincount(start_frame_I[lengths >= length_threshold], 
+                     minlength=n_frames)
+
 def get_worm_coils():
   
   #This function is very reliant on the MRC processor  
@@ -577,31 +955,28 @@ class Directions(object):
   
   """
   
-  def __init__(self,sx,sy,wp):
+  def __init__(self,nw):
     
     """
     
-    wp : (worm paritions) from normalized worm, 
+    nw : NormalizedWorm
+      The centroids of the partitions are taken from 
+      nw.get_partition_mean
     
     """
         
     #These are the names of the final fields
     NAMES = ['tail2head', 'head', 'tail']
     
-    #For each set of indices, compute the centroids of the tip and tail then
+    #For each set of partitions, get the centroids of the tip and tail then
     #compute a direction vector between them (tip - tail)
 
-    TIP_I  = [wp['head'], wp['head_tip'], wp['tail_tip']] #I - "indices" - really a tuple of start,stop
-    TAIL_I = [wp['tail'], wp['head_base'], wp['tail_base']]
-
-    TIP_S  = [slice(*x) for x in TIP_I] #S - slice
-    TAIL_S = [slice(*x) for x in TAIL_I]
+    TIP_KEYS  = ['head', 'head_tip', 'tail_tip']
+    TAIL_KEYS = ['tail', 'head_base', 'tail_base']
       
     for iVector in range(3):
-      tip_x  = np.mean(sx[TIP_S[iVector], :],axis=0)
-      tip_y  = np.mean(sy[TIP_S[iVector], :],axis=0)
-      tail_x = np.mean(sx[TAIL_S[iVector], :],axis=0)
-      tail_y = np.mean(sy[TAIL_S[iVector], :],axis=0)
+      tip_x,  tip_y  = nw.get_partition_mean(TIP_KEYS[iVector])
+      tail_x, tail_y = nw.get_partition_mean(TAIL_KEYS[iVector])
       
       dir_value = 180/np.pi*np.arctan2(tip_y - tail_y, tip_x - tail_x)
       setattr(self,NAMES[iVector],dir_value)
@@ -615,7 +990,15 @@ def get_eigenworms(sx,sy,eigen_worms,N_EIGENWORMS_USE):
   
   Parameters:
   ---------------------------------
+  sx, sy: [49,n_frames]
+    The skeleton x and y coordinates
   eigen_worms: [7,48]  
+  N_EIGENWORMS_USE: int
+    The number of eigenworms to project onto
+    
+  Returns
+  ---------------------------------
+  eigen_projection: [N_EIGENWORMS_USE,n_frames]
 
   """  
 
@@ -638,28 +1021,15 @@ def get_eigenworms(sx,sy,eigen_worms,N_EIGENWORMS_USE):
     mask_pos = np.concatenate((false_row,np.diff(angles,n=1,axis=0) > np.pi),axis=0) 
     mask_neg = np.concatenate((false_row,np.diff(angles,n=1,axis=0) < -np.pi),axis=0)   
 
-  #Only fix the frames we need to, in which there is a jump in going from one
-  #segment to the next ...
-  fix_frames_I = (np.any(np.logical_or(mask_pos,mask_neg),axis=0)).nonzero()[0]
-    
-  for cur_frame in fix_frames_I:
-    
-    positive_jump_I = (mask_pos[:,cur_frame]).nonzero()[0]
-    negative_jump_I = (mask_neg[:,cur_frame]).nonzero()[0]
-  
-    # subtract 2pi from remainging data after positive jumps
-    # Note that the jumps impact all subsequent frames
-    for cur_pos_jump in positive_jump_I:
-      angles[cur_pos_jump:,cur_frame] -= 2*np.pi
-      
-    # add 2pi to remaining data after negative jumps
-    for cur_neg_jump in negative_jump_I:
-      angles[cur_neg_jump:,cur_frame] += 2*np.pi
+  #Each jump shifts all subsequent angles of the frame, so the total shift
+  #at each angle is the number of jumps up to and including it. Frames 
+  #without jumps get a shift of 0.
+  n_jumps = np.cumsum(mask_neg,axis=0) - np.cumsum(mask_pos,axis=0)
+  angles  = angles + 2*np.pi*n_jumps
 
   angles = angles - np.mean(angles,axis=0)  
   
-  # DEBUG: hiding this error for now - @MichaelCurrie
-  return None # np.dot(eigen_worms[0:N_EIGENWORMS_USE,:],angles)
+  return np.dot(eigen_worms[0:N_EIGENWORMS_USE,:],angles)
   
 def gausswin(L,a = 2.5):
    
@@ -4,6 +4,7 @@
 """
 import matplotlib.pyplot as plt
 import numpy as np
+from scipy.ndimage import maximum_filter1d
 import pdb
 
 #Training wheels for Jim :/
@@ -43,7 +44,7 @@ def max_peaks_dist(x, dist, use_max, value_cutoff):
          peaks   - the maximum peaks
          indices - the indices for the peaks
   
-     See also MINPEAKSDIST, COMPUTECHAINCODELENGTHS
+     See also MINPEAKSDIST, COMPUTECHAINCODELENGTHS, max_peaks_dist_2d
   
      ****************
      Used in seg_worm.feature_helpers.posture.getAmplitudeAndWavelength
@@ -52,118 +53,182 @@ def max_peaks_dist(x, dist, use_max, value_cutoff):
   """
   #https://github.com/JimHokanson/SegwormMatlabClasses/blob/master/%2Bseg_worm/%2Butil/maxPeaksDist.m
  
-  chain_code_lengths = colon(1,1,x.size)
-
   # Is the vector larger than the search window?
   winSize = 2*dist + 1
-  if chain_code_lengths[-1] < winSize:
+  if x.size < winSize:
     temp_I = np.argmax(x)
     return (x[temp_I],temp_I)
-    
-  #xt - "x for testing" in some places in the code below
-  #it will be quicker (and/or easier) to assume that we want the largest
-  #value. By negating the data we can look for maxima (which will tell us
-  #where the minima are)
+  
   if not use_max:
-    xt = -1*x
-  else:
-    xt = x
-    
-  #NOTE: I added left/right neighbor comparisions which really helped with
-  #the fft ..., a point can't be a peak if it is smaller than either of its
-  #neighbors
-  if use_max:    
-    #                                           %> left                     > right
-    #Matlab version:    
-    #could_be_a_peak = x > value_cutoff & [true x(2:end) > x(1:end-1)] & [x(1:end-1) > x(2:end) true];
-    #
-    #TODO: Simplify how this code looks
-    could_be_a_peak = np.logical_and(x > value_cutoff,np.concatenate((np.ones(1,dtype=np.bool),x[1:] > x[0:-1])))
-    could_be_a_peak = np.logical_and(could_be_a_peak,np.concatenate((x[0:-1] > x[1:],np.ones(1,dtype=np.bool))))
-
-    I1 = could_be_a_peak.nonzero()[0]    
-    I2 = np.argsort(-1*x[I1]) #-1 => we want largest first
-    I  = I1[I2]
-  else:
     raise Exception("Not yet implemented")
-    pdb.set_trace()
     #could_be_a_peak = x < value_cutoff & [true x(2:end) < x(1:end-1)] & [x(1:end-1) < x(2:end) true];
     #I1     = find(could_be_a_peak);
     #[~,I2] = sort(x(I1));
     #I = I1(I2);
+    
+  is_peak_mask = h__getMaxPeaksMask(x[None,:], dist, np.array([value_cutoff]))[0]
+  
+  indices = is_peak_mask.nonzero()[0]
+  peaks   = x[indices]
+  
+  return (peaks,indices)
 
+def max_peaks_dist_2d(x, dist, use_max, value_cutoff):
+  """
+  Like max_peaks_dist, but finds the peaks of every row of a matrix at once.
+  
+  Parameters
+  ---------------------------------------
+  x : [n_rows x n_points]
+  dist : int
+    The minimum distance between peaks
+  use_max : bool
+    Only True (find maxima) is implemented
+  value_cutoff : scalar or [n_rows]
+    Peaks must be greater than this value
+    
+  Returns
+  ---------------------------------------
+  is_peak_mask : [n_rows x n_points]
+    True at the indices of the peaks of each row
+  
+  """
+  
+  if not use_max:
+    raise Exception("Not yet implemented")
+  
+  n_rows, n_points = x.shape
+  value_cutoff = np.broadcast_to(value_cutoff, (n_rows,))
+  
+  # Is the vector larger than the search window?
+  if n_points < 2*dist + 1:
+    is_peak_mask = np.zeros(x.shape, dtype=bool)
+    if n_points > 0:
+      is_peak_mask[np.arange(n_rows), np.argmax(x, axis=1)] = True
+    return is_peak_mask
+  
+  return h__getMaxPeaksMask(x, dist, value_cutoff)
 
-
-  n_points = x.size
-
+def h__getMaxPeaksMask(x, dist, value_cutoff):
+  """
+  The guts of max_peaks_dist, for the rows of x
+  
+  Parameters
+  ---------------------------------------
+  x : [n_rows x n_points]
+  dist : int
+  value_cutoff : [n_rows]
+  
+  Returns
+  ---------------------------------------
+  is_peak_mask : [n_rows x n_points]
+  
+  Notes
+  ---------------------------------------
+  The original code visits the possible peaks from largest to smallest.
+  Each visited point blocks all points within its window from being
+  visited, and is a peak if it is the max of its window:
+  
+     for cur_index in I:
+       if could_be_a_peak[cur_index]:
+         could_be_a_peak[start_I[cur_index]:end_I[cur_index]] = False
+         is_peak_mask[cur_index] = np.max(x[start_I[cur_index]:end_I[cur_index]]) == x[cur_index]
+  
+  Here the window maxima are precomputed for all windows, and instead of
+  looping over the points we loop over "rounds". In each round every point 
+  that is waiting on nothing but smaller points is resolved, either as 
+  blocked (by a visited point) or as visited. Points only depend on the 
+  points within their window, so this takes very few rounds. Ties in 
+  value are visited from left to right.
+  
+  """
+  n_rows, n_points = x.shape
+  
   #This code would need to be fixed if real distances
   #are input ...
   too_close = dist - 1
-
-  temp_I  = colon(0,1,n_points-1)
-  start_I = temp_I - too_close #Note, separated by dist is ok
-  #This sets the off limits area, so we go in by 1
-  end_I   = temp_I + too_close
   
-  start_I[start_I < 0] = 0
-  end_I[end_I > n_points] = n_points
-
-
-  is_peak_mask = np.zeros(n_points,dtype=bool)
-  #a peak and thus can not be used as a peak
+  #NOTE: I added left/right neighbor comparisions which really helped with
+  #the fft ..., a point can't be a peak if it is smaller than either of its
+  #neighbors
+  #
+  #Matlab version:    
+  #could_be_a_peak = x > value_cutoff & [true x(2:end) > x(1:end-1)] & [x(1:end-1) > x(2:end) true];
+  is_greater_than_left  = np.ones(x.shape, dtype=bool)
+  is_greater_than_right = np.ones(x.shape, dtype=bool)
+  is_greater_than_left[:,1:]   = x[:,1:] > x[:,:-1]
+  is_greater_than_right[:,:-1] = x[:,:-1] > x[:,1:]
+  with np.errstate(invalid='ignore'):
+    could_be_a_peak = (x > value_cutoff[:,None]) & is_greater_than_left & \
+                      is_greater_than_right
+  
+  #The max of the window of each point, i.e. x[i-too_close:i+too_close]
+  #Note, separated by dist is ok
+  window_max = maximum_filter1d(x, max(2*too_close,1), axis=1, 
+                                mode='constant', cval=-np.inf)
+  
+  #Only the possible peaks can block other points, so from here on we work
+  #with a list of them. Their positions are offset by row so that points
+  #in different rows are never within a window of each other.
+  row_I, column_I = could_be_a_peak.nonzero()
+  position = row_I*(n_points + 2*dist) + column_I
+  value    = x[row_I, column_I]
+  n_possible = len(position)
+  
+  #Find all pairs (j blocks i), where i is in j's window and j is visited 
+  #before i. Point j's window is j-too_close to j+too_close-1, so looking
+  #at a pair of points with j to the left of i ...
+  #--------------------------------------------------------------------
+  blocker_I = []
+  blocked_I = []
+  for n_apart in range(1, n_possible):
+    left_I   = np.arange(n_possible - n_apart)
+    right_I  = left_I + n_apart
+    distance = position[right_I] - position[left_I]
+    if not np.any(distance <= too_close):
+      break
+    #A larger value goes first, ties go from left to right
+    left_first = value[left_I] >= value[right_I]
     
-  for cur_index in I:
+    left_blocks_right = (distance <= too_close - 1) & left_first
+    right_blocks_left = (distance <= too_close) & ~left_first
     
-    #NOTE: This gets updated in the loop so we can't just iterate
-    #over these values
-    if could_be_a_peak[cur_index]:
-      #NOTE: Even if a point isn't the local max, it is greater
-      #than anything that is by it that is currently not taken
-      #(because of sorting), so it prevents these points
-      #from undergoing the expensive search of determining
-      #whether they are the min or max within their
-      #else from being used, so we might as well mark those indices
-      #within it's distance as taken as well
-      temp_indices = slice(start_I[cur_index],end_I[cur_index])
-      could_be_a_peak[temp_indices] = False
-      
-      #This line is really slow ...
-      #It would be better to precompute the max within a window
-      #for all windows ...
-      is_peak_mask[cur_index] = np.max(xt[temp_indices]) == xt[cur_index]
+    blocker_I.extend((left_I[left_blocks_right], right_I[right_blocks_left]))
+    blocked_I.extend((right_I[left_blocks_right], left_I[right_blocks_left]))
   
-  indices = is_peak_mask.nonzero()[0]
-  peaks   = x[indices]
+  if blocker_I:
+    blocker_I = np.concatenate(blocker_I)
+    blocked_I = np.concatenate(blocked_I)
+  else:
+    blocker_I = np.zeros(0, dtype=int)
+    blocked_I = np.zeros(0, dtype=int)
   
-  """
-  is_peak_mask   = false(1,n_points);
-  %a peak and thus can not be used as a peak
-  n_sort = length(I);
-  for iElem = 1:n_sort
-      cur_index = I(iElem);
-      if could_be_a_peak(cur_index)
-          %NOTE: Even if a point isn't the local max, it is greater
-          %than anything that is by it that is currently not taken
-          %(because of sorting), so it prevents these points
-          %from undergoing the expensive search of determining
-          %whether they are the min or max within their
-          %else from being used, so we might as well mark those indices
-          %within it's distance as taken as well
-          temp_indices = start_I(cur_index):end_I(cur_index);
-          could_be_a_peak(temp_indices) = false;
-          
-          %This line is really slow ...
-          %It would be better to precompute the max within a window
-          %for all windows ...
-          is_peak_mask(cur_index) = max(xt(temp_indices)) == xt(cur_index);
-      end
-  end
-  
-  indices = find(is_peak_mask);
-  peaks   = x(indices);
-  """
+  #Resolve the points in rounds
+  #--------------------------------------------------------------------
+  UNVISITED = 0
+  VISITED   = 1
+  BLOCKED   = 2
   
-  return (peaks,indices)
+  state = np.zeros(n_possible, dtype=int)
+  
+  is_unvisited = np.ones(n_possible, dtype=bool)
+  while np.any(is_unvisited):
+    blocker_state = state[blocker_I]
+    is_blocked = np.bincount(blocked_I[blocker_state == VISITED],
+                             minlength=n_possible) > 0
+    is_waiting = np.bincount(blocked_I[blocker_state == UNVISITED],
+                             minlength=n_possible) > 0
+    
+    state[is_unvisited & is_blocked] = BLOCKED
+    state[is_unvisited & ~is_blocked & ~is_waiting] = VISITED
+    is_unvisited = state == UNVISITED
+  
+  is_peak = (state == VISITED) & (window_max[row_I, column_I] == value)
+  
+  is_peak_mask = np.zeros(x.shape, dtype=bool)
+  is_peak_mask[row_I[is_peak], column_I[is_peak]] = True
+  
+  return is_peak_mask
   
 def colon(r1,inc,r2):
   
@@ -176,12 +241,12 @@ def colon(r1,inc,r2):
     return np.zeros(1)
   elif s == 1:
     n = ((r2-r1)+2*np.spacing(r2-r1))//inc
-    return np.linspace(r1,r1+inc*n,n+1)
+    return np.linspace(r1,r1+inc*n,int(n)+1)
   else: #s == -1:
     #NOTE: I think this is slightly off as we start on the wrong end
     #r1 should be exact, not r2
     n  = ((r1-r2)+2*np.spacing(r1-r2))//np.abs(inc)
-    temp = np.linspace(r2,r2+np.abs(inc)*n,n+1)    
+    temp = np.linspace(r2,r2+np.abs(inc)*n,int(n)+1)    
     return temp[::-1]  
 
 def print_object(obj):
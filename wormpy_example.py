@@ -117,6 +117,53 @@ def example_virtual_worm_pipeline(data_file_path):
   wp.show()
   
 
+def check_features_updater(nw, n_frames_per_append=1):
+  """
+    Check that a WormFeaturesUpdater, given the frames of nw a few at a 
+    time (e.g. one at a time, like a tracker), ends up with the same per 
+    frame features and motion codes as computing them for all of nw at once.
+    
+    The per frame features are compared to within rounding, as numpy may
+    sum the same values in a different order for arrays of different 
+    sizes. Returns True if they are the same.
+    
+  """
+  from wormpy.WormFeatures import WormFeaturesUpdater, WormFrameFeatures
+  from wormpy import feature_helpers
+  import numpy as np
+
+  n_frames = nw.num_frames
+  
+  updater = WormFeaturesUpdater()
+  for start in range(0, n_frames, n_frames_per_append):
+    updater.append(nw.get_frame_window(start, start + n_frames_per_append))
+  
+  # The whole worm in one window
+  expected = WormFrameFeatures(nw, max(n_frames, 1))
+  
+  for key, value in vars(expected).items():
+    if not np.allclose(getattr(updater.frame_features, key), value, 
+                       rtol=1e-10, atol=0, equal_nan=True):
+      print('Per frame feature differs: ' + key)
+      return False
+  
+  motion_codes = feature_helpers.get_motion_codes(expected.midbody_speed, 
+                                                  expected.length)
+  for key, value in motion_codes.items():
+    if key == 'mode':
+      is_same = np.array_equal(updater.motion_codes[key], value, 
+                               equal_nan=True)
+    else:
+      is_same = \
+        np.array_equal(updater.motion_codes[key].start_Is, value.start_Is) and \
+        np.array_equal(updater.motion_codes[key].end_Is, value.end_Is)
+    if not is_same:
+      print('Motion codes differ: ' + key)
+      return False
+  
+  return True
+  
+
 """
   We load the skeleton and other basic data from a worm HDF5 file,
   optionally animate it using matplotlib, and also    